@@ -1,43 +1,266 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, abort, Response, stream_with_context
 import os
+import json
+import math
+import threading
+from functools import wraps
+from importlib.machinery import ModuleSpec
+from werkzeug.exceptions import ServiceUnavailable
 from werkzeug.utils import secure_filename
 import uuid
 
-# Import the modules for image processing
-from modules.stitch import stitched_images
-from modules.roi import roi_select
-from modules.zoom import zoomed_image
-from modules.autofocus import auto_focus
+# The image processing modules (OpenCV, numpy) are imported by the views that
+# use them, on the first request or by the start-up warm-up, so that importing
+# the application stays fast
+from modules.outputs import OUTPUT_FORMATS, DEFAULT_OUTPUT_FORMAT, wait_for_output
+from modules.storage import StorageManager, UUID_NAME, hold
+from modules import shm_store, workers
+from modules.jobs import start_job, get_job, cancel_job
+
+# Background work belongs to the server process only: not to a process that
+# re-runs this module, nor to the parent of the Werkzeug reloader (python
+# app.py), which only watches files and runs the server in a child
+RELOADER_PARENT = __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+SERVER_PROCESS = __name__ != '__mp_main__' and not RELOADER_PARENT
 
 app = Flask(__name__)
 
+# Run as a script, this module would be re-run (as __mp_main__) in every
+# worker and job process. They only need the processing modules, so mark it as
+# main-only code, which multiprocessing does not re-run (after creating the
+# app: Flask locates its instance folder from the spec)
+if __name__ == '__main__':
+    __spec__ = ModuleSpec('__main__', None)
+
 # Configure upload folder
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tif', 'tiff'}
 
-# Create directories if they don't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PROCESSED_FOLDER, exist_ok=True)
-
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 
+# Let a front-end server (Apache mod_xsendfile, lighttpd) transfer files itself
+app.config['USE_X_SENDFILE'] = os.environ.get('MICROIMAGE_X_SENDFILE') == '1'
+
+# uuid-named artifacts never change once written, so clients may cache them for a year
+ARTIFACT_MAX_AGE = 365 * 24 * 60 * 60
+
+# Storage quotas and time-to-live of uploads and processed results
+MB = 1024 * 1024
+HOUR = 60 * 60
+UPLOAD_QUOTA_BYTES = int(os.environ.get('MICROIMAGE_UPLOAD_QUOTA_MB', 2048)) * MB
+PROCESSED_QUOTA_BYTES = int(os.environ.get('MICROIMAGE_PROCESSED_QUOTA_MB', 4096)) * MB
+UPLOAD_TTL_SECONDS = int(os.environ.get('MICROIMAGE_UPLOAD_TTL_HOURS', 24)) * HOUR
+PROCESSED_TTL_SECONDS = int(os.environ.get('MICROIMAGE_PROCESSED_TTL_HOURS', 24)) * HOUR
+SWEEP_INTERVAL_SECONDS = int(os.environ.get('MICROIMAGE_SWEEP_INTERVAL', 300))
+
+# Create the sharded storage directories and start their background sweepers
+uploads = StorageManager(UPLOAD_FOLDER, UPLOAD_QUOTA_BYTES, UPLOAD_TTL_SECONDS)
+processed = StorageManager(PROCESSED_FOLDER, PROCESSED_QUOTA_BYTES, PROCESSED_TTL_SECONDS)
+if SERVER_PROCESS:
+    uploads.start_sweeper(SWEEP_INTERVAL_SECONDS)
+    processed.start_sweeper(SWEEP_INTERVAL_SECONDS)
+
+# Start the worker processes and initialise OpenCV in the background, so the
+# first processing request does not pay for it (MICROIMAGE_WARM_UP=0 to start
+# them on first use instead)
+WARM_UP = os.environ.get('MICROIMAGE_WARM_UP', '1') != '0'
+if WARM_UP and SERVER_PROCESS:
+    threading.Thread(target=workers.warm_up, name='warm-up', daemon=True).start()
+
+# Processing requests allowed to run at once in this process
+MAX_CONCURRENT_JOBS = int(os.environ.get('MICROIMAGE_MAX_JOBS', max(1, (os.cpu_count() or 2) // 2)))
+_job_slots = threading.BoundedSemaphore(MAX_CONCURRENT_JOBS)
+
+# Seconds a request may wait for a processing slot or for a result that is
+# still being encoded. A waiting request holds a server thread, so the wait
+# stays short: after it, the request is answered 503 with Retry-After, and
+# the other server threads stay free to serve files.
+REQUEST_WAIT_SECONDS = float(os.environ.get('MICROIMAGE_REQUEST_WAIT', 1))
+RETRY_AFTER_SECONDS = 2
+
+# Zoom limits: output is bounded by the requested viewport, not the source size
+MAX_ZOOM_FACTOR = 100.0
+DEFAULT_VIEWPORT_SIZE = 1024
+MAX_VIEWPORT_SIZE = 4096
+
+# Seconds between keep-alive comments on an idle job event stream
+SSE_KEEPALIVE_SECONDS = 15
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def compute_bound(view=None, allow_async=False):
+    # Run a processing route only when a job slot is free (503 if none frees up
+    # within REQUEST_WAIT_SECONDS). Views that hand async=1 requests to
+    # start_job (allow_async) return at once for them; their job waits for a
+    # slot instead, without holding a server thread
+    if view is None:
+        return lambda view: compute_bound(view, allow_async)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if allow_async and get_flag(request.args, 'async'):
+            return view(*args, **kwargs)
+        if not _job_slots.acquire(timeout=REQUEST_WAIT_SECONDS):
+            raise ServiceUnavailable('All processing slots are busy, please retry',
+                                     retry_after=RETRY_AFTER_SECONDS)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _job_slots.release()
+    return wrapper
+
+def send_artifact(storage, filename):
+    path = storage.find(filename)
+    if path is None:
+        abort(404)
+    
+    # Conditional send: ETag/Last-Modified revalidation and HTTP range requests
+    immutable = UUID_NAME.search(filename) is not None
+    response = send_from_directory(os.path.dirname(path), filename, conditional=True, etag=True,
+                                   max_age=ARTIFACT_MAX_AGE if immutable else 0)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def wait_for_processed(filename):
+    # Wait briefly for a result still being encoded in the background (503 if
+    # it is not ready by then)
+    path = processed.path_for(secure_filename(filename), create=False)
+    if not wait_for_output(path, REQUEST_WAIT_SECONDS) and os.path.exists(f"{path}.part"):
+        raise ServiceUnavailable('The image is still being saved, please retry',
+                                 retry_after=RETRY_AFTER_SECONDS)
+
+def find_processed(filename):
+    # Look up a processed result once it is complete
+    wait_for_processed(filename)
+    return processed.find(secure_filename(filename))
+
+def find_image(filename):
+    # Look in the processed folder first, then in the uploads folder
+    return find_processed(filename) or uploads.find(secure_filename(filename))
+
+def get_output_options(params):
+    # Parse the output format, encoder quality and preview flag of a request
+    output_format = OUTPUT_FORMATS.get(params.get('format', DEFAULT_OUTPUT_FORMAT).lower())
+    if output_format is None:
+        formats = ', '.join(sorted(set(OUTPUT_FORMATS.values())))
+        raise ValueError(f'Output format must be one of: {formats}')
+    
+    quality = params.get('quality')
+    if quality in (None, ''):
+        quality = None
+    else:
+        try:
+            quality = int(quality)
+        except ValueError:
+            quality = 0
+        if not 1 <= quality <= 100:
+            raise ValueError('Quality must be an integer between 1 and 100')
+    
+    preview = get_flag(params, 'preview')
+    return output_format, quality, preview
+
+def get_flag(params, name):
+    return params.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+def get_zoom_options(params):
+    # Parse the zoom factor, centre point and viewport size of a request
+    try:
+        zoom_factor = float(params.get('zoom_factor', 2.0))
+        center_x = params.get('center_x')
+        center_y = params.get('center_y')
+        center_x = float(center_x) if center_x not in (None, '') else None
+        center_y = float(center_y) if center_y not in (None, '') else None
+        max_width = int(params.get('max_width', DEFAULT_VIEWPORT_SIZE))
+        max_height = int(params.get('max_height', DEFAULT_VIEWPORT_SIZE))
+    except ValueError:
+        raise ValueError('Invalid zoom parameters')
+    
+    if not 1.0 <= zoom_factor <= MAX_ZOOM_FACTOR:
+        raise ValueError(f'Zoom factor must be between 1x and {MAX_ZOOM_FACTOR:g}x')
+    
+    if not (0 < max_width <= MAX_VIEWPORT_SIZE and 0 < max_height <= MAX_VIEWPORT_SIZE):
+        raise ValueError(f'Viewport size must be between 1 and {MAX_VIEWPORT_SIZE} pixels')
+    
+    # Centres outside the image are clamped, but nan/inf cannot be
+    if any(center is not None and not math.isfinite(center) for center in (center_x, center_y)):
+        raise ValueError('Zoom centre must be a finite number')
+    
+    return {
+        'zoom_factor': zoom_factor,
+        'center_x': center_x,
+        'center_y': center_y,
+        'max_width': max_width,
+        'max_height': max_height
+    }
+
+def new_output_filenames(prefix, output_format, preview):
+    # Build the filenames of a processing result and of its optional preview
+    name = f"{prefix}_{uuid.uuid4().hex}"
+    preview_filename = f"{name}_preview.jpg" if preview else None
+    return f"{name}.{output_format}", preview_filename
+
+def output_details(message, output_filename, preview_filename=None, **details):
+    result = {
+        'message': message,
+        'filename': output_filename,
+        'url': f'/processed/{output_filename}',
+        **details
+    }
+    if preview_filename:
+        # The preview is ready now, the full-quality file may still be encoding
+        result['preview_filename'] = preview_filename
+        result['preview_url'] = f'/processed/{preview_filename}'
+    return result
+
+def output_response(message, output_filename, preview_filename=None, **details):
+    return jsonify(output_details(message, output_filename, preview_filename, **details))
+
+def job_response(job):
+    # 202 Accepted: progress is streamed from events_url, the result is in status_url
+    return jsonify({
+        **job.snapshot(),
+        'status_url': f'/jobs/{job.id}',
+        'events_url': f'/jobs/{job.id}/events',
+        'cancel_url': f'/jobs/{job.id}/cancel'
+    }), 202
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_artifact(uploads, filename)
 
 @app.route('/processed/<filename>')
 def processed_file(filename):
-    return send_from_directory(app.config['PROCESSED_FOLDER'], filename)
+    # Artifacts encoded in the background are served once they are complete
+    wait_for_processed(filename)
+    return send_artifact(processed, filename)
+
+@app.errorhandler(ServiceUnavailable)
+def service_unavailable(e):
+    # Busy: a JSON error like the other API errors, with Retry-After
+    response = jsonify({'error': e.description})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats_endpoint():
+    return jsonify({
+        'uploads': uploads.stats(),
+        'processed': processed.stats(),
+        'shared_memory': shm_store.stats()
+    })
 
 @app.route('/upload_images', methods=['POST'])
 def upload_images_endpoint():
@@ -55,7 +278,7 @@ def upload_images_endpoint():
             filename = secure_filename(file.filename)
             # Add unique identifier to prevent filename collisions
             unique_filename = f"{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            file_path = uploads.path_for(unique_filename)
             file.save(file_path)
             filenames.append(unique_filename)
     
@@ -68,32 +291,60 @@ def upload_images_endpoint():
     })
 
 @app.route('/stitch_images', methods=['GET'])
+@compute_bound(allow_async=True)
 def stitch_images_endpoint():
+    from modules.calibration import valid_profile_name
+    from modules.stitch import stitched_images
+    
     filenames = request.args.getlist('filenames')
     
     if not filenames:
         return jsonify({'error': 'No filenames provided'}), 400
     
-    file_paths = [os.path.join(app.config['UPLOAD_FOLDER'], filename) for filename in filenames]
+    try:
+        output_format, quality, preview = get_output_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Optional calibration profile of the microscope setup (e.g. scope1_20x)
+    profile = request.args.get('profile') or None
+    if profile is not None and not valid_profile_name(profile):
+        return jsonify({'error': 'Invalid calibration profile name'}), 400
     
     # Check if all files exist
-    for path in file_paths:
-        if not os.path.exists(path):
-            return jsonify({'error': f'File {os.path.basename(path)} not found'}), 404
+    file_paths = []
+    for filename in filenames:
+        path = uploads.find(secure_filename(filename))
+        if path is None:
+            return jsonify({'error': f'File {filename} not found'}), 404
+        file_paths.append(path)
     
     try:
-        output_filename = f"stitched_{uuid.uuid4().hex}.jpg"
-        output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+        output_filename, preview_filename = new_output_filenames('stitched', output_format, preview)
+        output_path = processed.path_for(output_filename)
+        preview_path = processed.path_for(preview_filename) if preview else None
+        
+        def stitched(success):
+            # Keep the tiles for as long as the mosaic exists
+            for path in file_paths:
+                uploads.add_reference(path, output_path)
+            return output_details('Images stitched successfully', output_filename, preview_filename)
+        
+        if get_flag(request.args, 'async'):
+            # Run in a job process and stream its progress
+            job = start_job('stitch', stitched_images,
+                            dict(image_paths=file_paths, output_path=output_path, quality=quality,
+                                 preview_path=preview_path, profile=profile),
+                            _job_slots, file_paths, (output_path, preview_path),
+                            on_success=stitched, error_message='Failed to stitch images')
+            return job_response(job)
         
         # Perform image stitching
-        success = stitched_images(file_paths, output_path)
+        with hold(*file_paths):
+            success = stitched_images(file_paths, output_path, quality, preview_path, profile)
         
         if success:
-            return jsonify({
-                'message': 'Images stitched successfully',
-                'filename': output_filename,
-                'url': f'/processed/{output_filename}'
-            })
+            return jsonify(stitched(success))
         else:
             return jsonify({'error': 'Failed to stitch images'}), 500
             
@@ -101,7 +352,10 @@ def stitch_images_endpoint():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/roi_selection', methods=['POST'])
+@compute_bound
 def roi_selection_endpoint():
+    from modules.roi import roi_select
+    
     # Get ROI coordinates from the request
     try:
         x = int(request.form.get('x', 0))
@@ -111,31 +365,34 @@ def roi_selection_endpoint():
     except ValueError:
         return jsonify({'error': 'Invalid ROI coordinates'}), 400
     
+    try:
+        output_format, quality, preview = get_output_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     # Get the filename of the stitched image from the request
     stitched_filename = request.form.get('stitched_filename')
     if not stitched_filename:
         return jsonify({'error': 'No stitched image filename provided'}), 400
     
-    # Construct the path to the stitched image in the PROCESSED folder
-    input_path = os.path.join(app.config['PROCESSED_FOLDER'], stitched_filename)
+    # Find the stitched image in the PROCESSED folder
+    input_path = find_processed(stitched_filename)
     
     # Check if the stitched image exists
-    if not os.path.exists(input_path):
+    if input_path is None:
         return jsonify({'error': 'Stitched image not found'}), 404
     
     # Extract ROI
-    output_filename = f"roi_{uuid.uuid4().hex}.jpg"
-    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+    output_filename, preview_filename = new_output_filenames('roi', output_format, preview)
+    output_path = processed.path_for(output_filename)
+    preview_path = processed.path_for(preview_filename) if preview else None
     
     try:
-        success = roi_select(input_path, output_path, x, y, width, height)
+        with hold(input_path):
+            success = roi_select(input_path, output_path, x, y, width, height, quality, preview_path)
         
         if success:
-            return jsonify({
-                'message': 'ROI extracted successfully',
-                'filename': output_filename,
-                'url': f'/processed/{output_filename}'
-            })
+            return output_response('ROI extracted successfully', output_filename, preview_filename)
         else:
             return jsonify({'error': 'Failed to extract ROI'}), 500
             
@@ -143,46 +400,54 @@ def roi_selection_endpoint():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/zoom', methods=['POST'])
+@compute_bound
 def zoom_endpoint():
-    if 'image' not in request.files:
-        return jsonify({'error': 'No image file in the request'}), 400
-    
-    file = request.files['image']
-    
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    from modules.zoom import zoom_view
     
-    if not allowed_file(file.filename):
-        return jsonify({'error': 'File type not allowed'}), 400
+    # Zoom either an existing upload/processed image (served from its cached
+    # pyramid) or a newly uploaded file
+    image_filename = request.form.get('filename')
+    if image_filename:
+        input_path = find_image(image_filename)
+        if input_path is None:
+            return jsonify({'error': 'Image not found'}), 404
+    else:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image file in the request'}), 400
+        
+        file = request.files['image']
+        
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'File type not allowed'}), 400
     
-    # Get zoom factor from the request
+    # Get zoom factor, centre point and viewport size from the request
     try:
-        zoom_factor = float(request.form.get('zoom_factor', 2.0))
-        # Limit zoom factor to 10x or 20x as per requirements
-        if zoom_factor not in [10.0, 20.0]:
-            return jsonify({'error': 'Zoom factor must be 10x or 20x'}), 400
-    except ValueError:
-        return jsonify({'error': 'Invalid zoom factor'}), 400
+        zoom = get_zoom_options(request.form)
+        output_format, quality, preview = get_output_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Save the uploaded file
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-    input_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-    file.save(input_path)
+    if not image_filename:
+        # Save the uploaded file
+        filename = secure_filename(file.filename)
+        unique_filename = f"{uuid.uuid4().hex}_{filename}"
+        input_path = uploads.path_for(unique_filename)
+        file.save(input_path)
     
     # Apply zoom
-    output_filename = f"zoomed_{uuid.uuid4().hex}.jpg"
-    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+    output_filename, preview_filename = new_output_filenames('zoomed', output_format, preview)
+    output_path = processed.path_for(output_filename)
+    preview_path = processed.path_for(preview_filename) if preview else None
     
     try:
-        success = zoomed_image(input_path, output_path, zoom_factor)
+        with hold(input_path):
+            success = zoom_view(input_path, output_path, quality=quality, preview_path=preview_path, **zoom)
         
         if success:
-            return jsonify({
-                'message': 'Image zoomed successfully',
-                'filename': output_filename,
-                'url': f'/processed/{output_filename}'
-            })
+            return output_response('Image zoomed successfully', output_filename, preview_filename)
         else:
             return jsonify({'error': 'Failed to zoom image'}), 500
             
@@ -190,37 +455,204 @@ def zoom_endpoint():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/auto_focus', methods=['GET'])
+@compute_bound(allow_async=True)
 def auto_focus_endpoint():
+    from modules.autofocus import auto_focus, auto_focus_adaptive
+    
     if 'image' not in request.args:
         return jsonify({'error': 'No image specified'}), 400
     
     image_filename = request.args.get('image')
-    input_path = os.path.join(app.config['PROCESSED_FOLDER'], image_filename)
+    input_path = find_image(image_filename)
     
-    if not os.path.exists(input_path):
-        # Also check in uploads folder
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-        if not os.path.exists(input_path):
-            return jsonify({'error': 'Image not found'}), 404
+    if input_path is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    try:
+        output_format, quality, preview = get_output_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Adaptive mode measures focus and noise first and skips the stages the image does not need
+    adaptive = get_flag(request.args, 'adaptive')
     
     # Apply auto-focus enhancement
-    output_filename = f"focused_{uuid.uuid4().hex}.jpg"
-    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+    output_filename, preview_filename = new_output_filenames('focused', output_format, preview)
+    output_path = processed.path_for(output_filename)
+    preview_path = processed.path_for(preview_filename) if preview else None
+    
+    def focused(result):
+        if adaptive:
+            return output_details('Auto-focus applied successfully', output_filename, preview_filename,
+                                  focus_report=result)
+        return output_details('Auto-focus applied successfully', output_filename, preview_filename)
     
     try:
-        success = auto_focus(input_path, output_path)
+        if get_flag(request.args, 'async'):
+            # Run in a job process and stream its progress
+            job = start_job('auto_focus', auto_focus_adaptive if adaptive else auto_focus,
+                            dict(input_path=input_path, output_path=output_path, quality=quality,
+                                 preview_path=preview_path),
+                            _job_slots, (input_path,), (output_path, preview_path),
+                            on_success=focused, error_message='Failed to apply auto-focus')
+            return job_response(job)
         
-        if success:
-            return jsonify({
-                'message': 'Auto-focus applied successfully',
-                'filename': output_filename,
-                'url': f'/processed/{output_filename}'
-            })
+        with hold(input_path):
+            if adaptive:
+                result = auto_focus_adaptive(input_path, output_path, quality, preview_path)
+            else:
+                result = auto_focus(input_path, output_path, quality, preview_path)
+        
+        if result:
+            return jsonify(focused(result))
         else:
             return jsonify({'error': 'Failed to apply auto-focus'}), 500
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/pipeline', methods=['GET'])
+@compute_bound(allow_async=True)
+def pipeline_endpoint():
+    from modules.calibration import valid_profile_name
+    from modules.pipeline import run_pipeline
+    
+    # Chain stitch (or a single image) -> ROI -> zoom -> auto-focus in the worker
+    # processes; intermediate images stay in shared memory and only the final
+    # result is encoded
+    filenames = request.args.getlist('filenames')
+    image_filename = request.args.get('image')
+    
+    if filenames:
+        file_paths = []
+        for filename in filenames:
+            path = uploads.find(secure_filename(filename))
+            if path is None:
+                return jsonify({'error': f'File {filename} not found'}), 404
+            file_paths.append(path)
+    elif image_filename:
+        path = find_image(image_filename)
+        if path is None:
+            return jsonify({'error': 'Image not found'}), 404
+        file_paths = [path]
+    else:
+        return jsonify({'error': 'No filenames or image provided'}), 400
+    
+    try:
+        output_format, quality, preview = get_output_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    profile = request.args.get('profile') or None
+    if profile is not None and not valid_profile_name(profile):
+        return jsonify({'error': 'Invalid calibration profile name'}), 400
+    
+    # Optional ROI: all four coordinates are required
+    roi_keys = ('x', 'y', 'width', 'height')
+    roi = None
+    if any(request.args.get(key) for key in roi_keys):
+        try:
+            roi = tuple(int(request.args[key]) for key in roi_keys)
+        except (KeyError, ValueError):
+            return jsonify({'error': 'Invalid ROI coordinates'}), 400
+        if roi[2] <= 0 or roi[3] <= 0:
+            return jsonify({'error': 'ROI width and height must be positive'}), 400
+    
+    # Optional zoom
+    zoom = None
+    if request.args.get('zoom_factor'):
+        try:
+            zoom = get_zoom_options(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # Optional auto-focus, adaptive or standard
+    focus = None
+    if get_flag(request.args, 'focus'):
+        focus = 'adaptive' if get_flag(request.args, 'adaptive') else 'standard'
+    
+    output_filename, preview_filename = new_output_filenames('pipeline', output_format, preview)
+    output_path = processed.path_for(output_filename)
+    preview_path = processed.path_for(preview_filename) if preview else None
+    
+    def completed(result):
+        if len(file_paths) > 1:
+            # Keep the tiles for as long as the result exists
+            for path in file_paths:
+                uploads.add_reference(path, output_path)
+        return output_details('Pipeline completed successfully', output_filename, preview_filename,
+                              **result)
+    
+    try:
+        if get_flag(request.args, 'async'):
+            # Run in a job process and stream its progress
+            tag = uuid.uuid4().hex
+            job = start_job('pipeline', run_pipeline,
+                            dict(image_paths=file_paths, output_path=output_path, profile=profile, roi=roi,
+                                 zoom=zoom, focus=focus, quality=quality, preview_path=preview_path, tag=tag),
+                            _job_slots, file_paths, (output_path, preview_path),
+                            on_success=completed, error_message='Failed to run the processing pipeline',
+                            segment_tag=tag)
+            return job_response(job)
+        
+        with hold(*file_paths):
+            result = run_pipeline(file_paths, output_path, profile, roi, zoom, focus, quality, preview_path)
+        
+        if result is not None:
+            return jsonify(completed(result))
+        else:
+            return jsonify({'error': 'Failed to run the processing pipeline'}), 500
+            
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_endpoint(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events_endpoint(job_id):
+    # Server-Sent Events: one 'progress' event per report, then a final event
+    # named after the outcome (done, failed or cancelled) carrying the job status
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    # Reconnecting clients continue after the last event they received
+    try:
+        position = max(0, int(request.headers.get('Last-Event-ID', -1)) + 1)
+    except ValueError:
+        position = 0
+    
+    def stream(position):
+        while True:
+            events, finished = job.wait_events(position, SSE_KEEPALIVE_SECONDS)
+            for event in events:
+                yield f"id: {event['seq']}\nevent: progress\ndata: {json.dumps(event)}\n\n"
+            position += len(events)
+            if finished and not events:
+                snapshot = job.snapshot()
+                yield f"event: {snapshot['status']}\ndata: {json.dumps(snapshot)}\n\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+    
+    response = Response(stream_with_context(stream(position)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies (nginx) from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel_endpoint(job_id):
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development server only; use gunicorn -c gunicorn.conf.py app:app in production
+    app.run(debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Startup-time benchmark: how long a fresh server process takes to import the
+application and to serve its first processing requests, for each process
+start method, with and without the start-up warm-up, and what importing the
+application costs now that the processing modules load on first use.
+
+Usage: python benchmark_startup.py [--runs N]
+
+Every measurement runs in a new interpreter, as on a newly started instance.
+The application is imported as a module, as gunicorn does. Worker and job
+processes do not re-run it (nor app.py started as a script, see app.py).
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_IMAGE = 'startup_benchmark.png'
+
+
+#function to measure a cold import of the application, then of the processing modules it defers
+def measure_import():
+    started = time.perf_counter()
+    import app
+    result = {'import_s': time.perf_counter() - started}
+    from modules import workers
+    for name in workers.PRELOAD_MODULES:
+        importlib.import_module(name)
+    # What importing the application cost while it imported these modules itself
+    result['eager_import_s'] = time.perf_counter() - started
+    return result
+
+
+#function to measure one fresh server process (runs in a child interpreter)
+def measure(warm):
+    started = time.perf_counter()
+    import app
+    from modules import workers
+    from modules.jobs import get_job
+    result = {'import_s': time.perf_counter() - started}
+
+    if warm:
+        result['warm_up_s'] = workers.warm_up()
+
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8), (0, 0), 2.0)
+    input_path = app.uploads.path_for(BENCHMARK_IMAGE)
+    cv2.imwrite(input_path, image)
+
+    client = app.app.test_client()
+    outputs = []
+    try:
+        # Pipeline run by the worker pool, waited for by the request
+        for key in ('first_pipeline_s', 'second_pipeline_s'):
+            started = time.perf_counter()
+            response = client.get(f'/pipeline?image={BENCHMARK_IMAGE}&zoom_factor=2')
+            result[key] = time.perf_counter() - started
+            outputs.append(response.get_json()['filename'])
+
+        # Asynchronous job: time until its process reports the first progress event
+        for key in ('first_job_event_s', 'second_job_event_s'):
+            started = time.perf_counter()
+            response = client.get(f'/pipeline?image={BENCHMARK_IMAGE}&zoom_factor=2&async=1')
+            job = get_job(response.get_json()['job_id'])
+            while True:
+                snapshot = job.snapshot()
+                if snapshot['progress'] is not None or snapshot['status'] in ('done', 'failed', 'cancelled'):
+                    break
+                time.sleep(0.001)
+            result[key] = time.perf_counter() - started
+            while snapshot['status'] not in ('done', 'failed', 'cancelled'):
+                time.sleep(0.01)
+                snapshot = job.snapshot()
+            if snapshot.get('result'):
+                outputs.append(snapshot['result']['filename'])
+    finally:
+        os.remove(input_path)
+        for filename in outputs:
+            path = app.processed.find(filename)
+            if path is not None:
+                os.remove(path)
+        workers.shutdown()
+    return result
+
+
+#function to run a measurement in a new interpreter
+def run_fresh(start_method, mode):
+    env = dict(os.environ, MICROIMAGE_START_METHOD=start_method, MICROIMAGE_WARM_UP='0')
+    output = subprocess.run([sys.executable, __file__, '--measure', mode],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    # The measurement is the last line; the application prints its own messages before it
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3, help='fresh processes per configuration')
+    parser.add_argument('--measure', choices=('0', '1', 'import'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        print(json.dumps(measure_import() if args.measure == 'import' else measure(args.measure == '1')))
+        return
+
+    runs = [run_fresh(multiprocessing.get_start_method(), 'import') for _ in range(args.runs)]
+    print('cold import (median milliseconds over', args.runs, 'fresh processes)')
+    print(f"  application, processing modules on first use: {statistics.median(run['import_s'] for run in runs) * 1000:.1f}")
+    print(f"  application and processing modules (eager, as before): {statistics.median(run['eager_import_s'] for run in runs) * 1000:.1f}")
+    print()
+
+    columns = ['import_s', 'warm_up_s', 'first_pipeline_s', 'second_pipeline_s',
+               'first_job_event_s', 'second_job_event_s']
+    print(f"{'start method':<14}{'warm-up':<9}" + ''.join(f"{name[:-2]:>20}" for name in columns))
+    print('(median milliseconds over', args.runs, 'fresh processes)')
+    for start_method in ('spawn', 'forkserver'):
+        if start_method not in multiprocessing.get_all_start_methods():
+            continue
+        for warm in (False, True):
+            runs = [run_fresh(start_method, '1' if warm else '0') for _ in range(args.runs)]
+            cells = []
+            for name in columns:
+                values = [run[name] for run in runs if name in run]
+                cells.append(f"{statistics.median(values) * 1000:>20.1f}" if values else f"{'-':>20}")
+            print(f"{start_method:<14}{'yes' if warm else 'no':<9}" + ''.join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Production server configuration: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+
+bind = os.environ.get('MICROIMAGE_BIND', '0.0.0.0:8000')
+
+# Threaded workers: file transfers run on their own threads and do not queue
+# behind compute-bound requests (limited per process by MICROIMAGE_MAX_JOBS;
+# requests beyond it are answered 503 rather than holding a thread)
+worker_class = 'gthread'
+workers = int(os.environ.get('MICROIMAGE_WORKERS', max(2, multiprocessing.cpu_count() // 4)))
+threads = int(os.environ.get('MICROIMAGE_THREADS', 16))
+
+# Stitching large mosaics can take minutes
+timeout = int(os.environ.get('MICROIMAGE_TIMEOUT', 600))
+keepalive = 5
+
+# Zero-copy transfer of uploads/processed files via sendfile()
+sendfile = True
@@ -1,12 +1,52 @@
 import cv2
 import numpy as np
 import os
-from scipy import ndimage
+import threading
+import time
 
+from modules.encoding import write_image
+from modules.progress import StepTimer, timed_stage
+
+
+# Adaptive auto-focus: a grid of ASSESS_GRID x ASSESS_GRID full-resolution patches
+ASSESS_GRID = 4
+ASSESS_PATCH_SIZE = 128
+
+# Sharpest-patch focus (image_sharpness units) above which an image counts as crisp
+SHARP_FOCUS = 200.0
+
+# Noise floor (estimated standard deviation in grey levels) below which NL-means is skipped
+LOW_NOISE = 2.0
+
+# Optional stages the adaptive mode may skip, with their initial cost estimate
+# in milliseconds per megapixel ('pipeline' is everything else); refined as images are processed
+OPTIONAL_STAGES = ('denoise', 'detail')
+STAGE_COST_SMOOTHING = 0.2
+_stage_cost = {'denoise': 2000.0, 'detail': 4.0, 'pipeline': 150.0}
+_stage_cost_lock = threading.Lock()
+
+# Fixed filter kernels, built once per process
+DETAIL_KERNEL = np.array([[-0.5, -0.5, -0.5],
+                          [-0.5,  5.0, -0.5],
+                          [-0.5, -0.5, -0.5]])
+NOISE_KERNEL = np.array([[1, -2, 1],
+                         [-2, 4, -2],
+                         [1, -2, 1]], dtype=np.float32)
+
+# CLAHE objects keep state between calls, so each thread gets its own
+_clahe = threading.local()
+
+
+#function to get the CLAHE instance of the current thread, creating it on first use
+def get_clahe():
+    clahe = getattr(_clahe, 'instance', None)
+    if clahe is None:
+        clahe = _clahe.instance = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(4, 4))
+    return clahe
 
 
 #function to enhance the focus on image to increase clarity
-def auto_focus(input_path, output_path):
+def auto_focus(input_path, output_path, quality=None, preview_path=None, progress=None):
     try:
         # Check if the input image exists
         if not os.path.exists(input_path):
@@ -14,81 +54,19 @@ def auto_focus(input_path, output_path):
             return False
         
         # Read the input image
-        image = cv2.imread(input_path)
+        with timed_stage(progress, 'decode'):
+            image = cv2.imread(input_path)
         
         if image is None:
             print(f"Error: Failed to read image {input_path}")
             return False
         
-        # Step 1: Apply initial denoising to reduce noise before processing
-        denoised = cv2.fastNlMeansDenoisingColored(image, None, 7, 7, 7, 21)
-        
-        # Step 2: Convert to Lab color space for better color processing
-        lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        
-        # Step 3: Apply CLAHE on the L channel with microscope-specific parameters
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(4, 4))
-        enhanced_l = clahe.apply(l)
-        
-        # Step 4: Apply multi-scale unsharp masking for better detail enhancement
-        gaussian_1 = cv2.GaussianBlur(enhanced_l, (0, 0), 1.0)
-        gaussian_2 = cv2.GaussianBlur(enhanced_l, (0, 0), 3.0)
-        gaussian_3 = cv2.GaussianBlur(enhanced_l, (0, 0), 5.0)
-        
-        # Create multi-scale unsharp mask with weighted contributions
-        unsharp_1 = cv2.addWeighted(enhanced_l, 1.5, gaussian_1, -0.5, 0)
-        unsharp_2 = cv2.addWeighted(enhanced_l, 1.3, gaussian_2, -0.3, 0)
-        unsharp_3 = cv2.addWeighted(enhanced_l, 1.2, gaussian_3, -0.2, 0)
-        
-        # Combine the different scales
-        enhanced_l = cv2.addWeighted(unsharp_1, 0.4, unsharp_2, 0.3, 0)
-        enhanced_l = cv2.addWeighted(enhanced_l, 0.8, unsharp_3, 0.2, 0)
-        
-        # Step 5: Edge enhancement specific for microscope images
-        edges = cv2.Laplacian(enhanced_l, cv2.CV_8U, ksize=3)
-        edges = cv2.GaussianBlur(edges, (0, 0), 0.5)  # Smooth the edges slightly
-        enhanced_l = cv2.addWeighted(enhanced_l, 1.0, edges, 0.2, 0)
-        
-        # Step 6: Reconstruct the Lab image with enhanced luminance
-        enhanced_lab = cv2.merge([enhanced_l, a, b])
-        
-        # Step 7: Convert back to BGR
-        enhanced_bgr = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
-        
-        # Step 8: Apply microscope-specific detail enhancement
-        kernel = np.array([[-0.5, -0.5, -0.5],
-                           [-0.5,  5.0, -0.5],
-                           [-0.5, -0.5, -0.5]])
-        enhanced_bgr = cv2.filter2D(enhanced_bgr, -1, kernel)
-        
-        # Step 9: Apply targeted contrast enhancement
-        enhanced_bgr = cv2.convertScaleAbs(enhanced_bgr, alpha=1.15, beta=5)
-        
-        # Step 10: Remove any remaining noise while preserving edges
-        enhanced_bgr = cv2.bilateralFilter(enhanced_bgr, 5, 30, 30)
-        
-        # Step 11: Apply deconvolution-like effect to further enhance clarity (simplified)
-        # Create a sharpening kernel that mimics deconvolution
-        kernel_deconv = np.array([[-0.1, -0.15, -0.1],
-                                  [-0.15, 2.0, -0.15],
-                                  [-0.1, -0.15, -0.1]])
-        deconv_effect = cv2.filter2D(enhanced_bgr, -1, kernel_deconv)
-        
-        # Step 12: Apply local contrast enhancement for fine structures
-        for c in range(3):  # Apply to each channel
-            channel = enhanced_bgr[:,:,c]
-            blurred = cv2.GaussianBlur(channel, (0, 0), 10)
-            enhanced_bgr[:,:,c] = cv2.addWeighted(channel, 1.5, blurred, -0.5, 0)
-        
-        # Step 13: Apply final contrast normalization
-        enhanced_bgr = normalize_contrast(enhanced_bgr)
+        enhanced_bgr = enhance_focus(image, progress=progress)
         
         # Save the enhanced image
-        cv2.imwrite(output_path, enhanced_bgr)
-        
-        # Validate if file was created
-        if os.path.exists(output_path):
+        with timed_stage(progress, 'encode'):
+            saved = write_image(output_path, enhanced_bgr, quality, preview_path)
+        if saved:
             print(f"Enhanced image saved to {output_path}")
             return True
         else:
@@ -100,6 +78,224 @@ def auto_focus(input_path, output_path):
         return False
 
 
+#function to apply the 12-step enhancement chain, skipping the named optional stages
+def enhance_focus(image, skip=(), timings=None, progress=None):
+    """
+    Parameters:
+    - image: BGR image
+    - skip: Optional stages to leave out ('denoise', 'detail')
+    - timings: Optional dict that receives the seconds spent in each optional stage
+    - progress: Optional progress callback, called after each step
+
+    Returns:
+    - Enhanced BGR image
+    """
+    if timings is None:
+        timings = {}
+    steps = StepTimer(progress, 'focus', 12)
+
+    # Step 1: Apply initial denoising to reduce noise before processing
+    if 'denoise' in skip:
+        denoised = image
+    else:
+        started = time.perf_counter()
+        denoised = cv2.fastNlMeansDenoisingColored(image, None, 7, 7, 7, 21)
+        timings['denoise'] = time.perf_counter() - started
+    steps.done(1, 'denoise')
+    
+    # Step 2: Convert to Lab color space for better color processing
+    lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    steps.done(2, 'lab')
+    
+    # Step 3: Apply CLAHE on the L channel with microscope-specific parameters
+    enhanced_l = get_clahe().apply(l)
+    steps.done(3, 'clahe')
+    
+    # Step 4: Apply multi-scale unsharp masking for better detail enhancement
+    gaussian_1 = cv2.GaussianBlur(enhanced_l, (0, 0), 1.0)
+    gaussian_2 = cv2.GaussianBlur(enhanced_l, (0, 0), 3.0)
+    gaussian_3 = cv2.GaussianBlur(enhanced_l, (0, 0), 5.0)
+    
+    # Create multi-scale unsharp mask with weighted contributions
+    unsharp_1 = cv2.addWeighted(enhanced_l, 1.5, gaussian_1, -0.5, 0)
+    unsharp_2 = cv2.addWeighted(enhanced_l, 1.3, gaussian_2, -0.3, 0)
+    unsharp_3 = cv2.addWeighted(enhanced_l, 1.2, gaussian_3, -0.2, 0)
+    
+    # Combine the different scales
+    enhanced_l = cv2.addWeighted(unsharp_1, 0.4, unsharp_2, 0.3, 0)
+    enhanced_l = cv2.addWeighted(enhanced_l, 0.8, unsharp_3, 0.2, 0)
+    steps.done(4, 'unsharp_mask')
+    
+    # Step 5: Edge enhancement specific for microscope images
+    edges = cv2.Laplacian(enhanced_l, cv2.CV_8U, ksize=3)
+    edges = cv2.GaussianBlur(edges, (0, 0), 0.5)  # Smooth the edges slightly
+    enhanced_l = cv2.addWeighted(enhanced_l, 1.0, edges, 0.2, 0)
+    steps.done(5, 'edges')
+    
+    # Step 6: Reconstruct the Lab image with enhanced luminance
+    enhanced_lab = cv2.merge([enhanced_l, a, b])
+    steps.done(6, 'merge')
+    
+    # Step 7: Convert back to BGR
+    enhanced_bgr = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
+    steps.done(7, 'bgr')
+    
+    # Step 8: Apply microscope-specific detail enhancement
+    if 'detail' not in skip:
+        started = time.perf_counter()
+        enhanced_bgr = cv2.filter2D(enhanced_bgr, -1, DETAIL_KERNEL)
+        timings['detail'] = time.perf_counter() - started
+    steps.done(8, 'detail')
+    
+    # Step 9: Apply targeted contrast enhancement
+    enhanced_bgr = cv2.convertScaleAbs(enhanced_bgr, alpha=1.15, beta=5)
+    steps.done(9, 'contrast')
+    
+    # Step 10: Remove any remaining noise while preserving edges
+    enhanced_bgr = cv2.bilateralFilter(enhanced_bgr, 5, 30, 30)
+    steps.done(10, 'bilateral')
+    
+    # Step 11: Apply local contrast enhancement for fine structures
+    for c in range(3):  # Apply to each channel
+        channel = enhanced_bgr[:,:,c]
+        blurred = cv2.GaussianBlur(channel, (0, 0), 10)
+        enhanced_bgr[:,:,c] = cv2.addWeighted(channel, 1.5, blurred, -0.5, 0)
+    steps.done(11, 'local_contrast')
+    
+    # Step 12: Apply final contrast normalization
+    enhanced_bgr = normalize_contrast(enhanced_bgr)
+    steps.done(12, 'normalize')
+
+    return enhanced_bgr
+
+
+#function to estimate focus and noise from a sparse grid of full-resolution patches
+def assess_focus(image):
+    """
+    Cheap focus/noise estimate used to choose the enhancement plan.
+
+    Patches are measured at full resolution because downsampling hides both
+    defocus and sensor noise. The sharpest patch gives the focus (empty or
+    background regions do not count against a focused field), and the
+    flattest patch gives the noise floor.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    size = min(ASSESS_PATCH_SIZE, height, width)
+
+    focus = []
+    noise = []
+    for y in np.linspace(0, height - size, ASSESS_GRID).astype(int):
+        for x in np.linspace(0, width - size, ASSESS_GRID).astype(int):
+            patch = gray[y:y + size, x:x + size]
+            focus.append(image_sharpness(patch))
+            noise.append(estimate_noise(patch))
+
+    # Discount the sharpness that white noise of this level alone would produce
+    # (Laplacian variance 20*sigma^2, mean Sobel gradient magnitude ~4.34*sigma)
+    sigma = min(noise)
+    noise_sharpness = 0.5 * 20 * sigma ** 2 + 0.5 * 4.34 * sigma
+
+    return {'focus': float(max(0.0, max(focus) - noise_sharpness)), 'noise': float(sigma)}
+
+
+#function to choose which optional stages an image needs
+def choose_focus_plan(assessment):
+    sharp = assessment['focus'] >= SHARP_FOCUS
+    noisy = assessment['noise'] > LOW_NOISE
+
+    if sharp and not noisy:
+        # Nothing would improve: return the image as it is
+        return 'none', list(OPTIONAL_STAGES)
+    if sharp:
+        # Already crisp: only remove the noise
+        return 'light', ['detail']
+    if not noisy:
+        # Blurred but clean: sharpen without NL-means
+        return 'standard', ['denoise']
+    return 'full', []
+
+
+#function to run only the enhancement stages an image needs
+def enhance_focus_adaptive(image, progress=None):
+    """
+    Returns:
+    - (enhanced image, report dictionary)
+    """
+    started = time.perf_counter()
+    with timed_stage(progress, 'assess'):
+        assessment = assess_focus(image)
+        plan, skipped = choose_focus_plan(assessment)
+    
+    timings = {}
+    if plan == 'none':
+        enhanced_bgr = image
+    else:
+        enhanced_bgr = enhance_focus(image, skipped, timings, progress)
+    elapsed = time.perf_counter() - started
+    
+    # Learn the per-megapixel cost of the stages that ran, estimate the ones that did not
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+    with _stage_cost_lock:
+        for stage, seconds in timings.items():
+            _stage_cost[stage] += STAGE_COST_SMOOTHING * (seconds * 1000 / megapixels - _stage_cost[stage])
+        saved_ms = sum(_stage_cost[stage] for stage in skipped) * megapixels
+        if plan == 'none':
+            saved_ms += _stage_cost['pipeline'] * megapixels
+        elif elapsed > 0:
+            base = elapsed * 1000 / megapixels - sum(timings.values()) * 1000 / megapixels
+            _stage_cost['pipeline'] += STAGE_COST_SMOOTHING * (base - _stage_cost['pipeline'])
+    
+    report = {
+        'plan': plan,
+        'skipped_stages': skipped,
+        'focus': round(assessment['focus'], 2),
+        'noise': round(assessment['noise'], 2),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'time_saved_ms': round(saved_ms, 1),
+    }
+    return enhanced_bgr, report
+
+
+#function to enhance focus only as much as the image needs, reporting the chosen path
+def auto_focus_adaptive(input_path, output_path, quality=None, preview_path=None, progress=None):
+    """
+    Returns:
+    - Report dictionary (plan, skipped stages, focus/noise estimate, elapsed and
+      estimated saved milliseconds), or None on failure
+    """
+    try:
+        # Check if the input image exists
+        if not os.path.exists(input_path):
+            print(f"Error: Input image {input_path} does not exist")
+            return None
+        
+        # Read the input image
+        with timed_stage(progress, 'decode'):
+            image = cv2.imread(input_path)
+        
+        if image is None:
+            print(f"Error: Failed to read image {input_path}")
+            return None
+        
+        enhanced_bgr, report = enhance_focus_adaptive(image, progress)
+        
+        # Save the enhanced image
+        with timed_stage(progress, 'encode'):
+            saved = write_image(output_path, enhanced_bgr, quality, preview_path)
+        if not saved:
+            print(f"Error: Failed to save enhanced image to {output_path}")
+            return None
+        
+        print(f"Enhanced image saved to {output_path} (plan {report['plan']})")
+        return report
+        
+    except Exception as e:
+        print(f"Error in adaptive focus enhancement: {str(e)}")
+        return None
+
+
 #function to normalize the contrast of an image
 def normalize_contrast(image):
     # Convert to HSV for better color preservation
@@ -133,26 +329,38 @@ def measure_image_sharpness(image_path):
         # Convert to grayscale
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         
-        # Calculate Laplacian
-        laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-        laplacian_var = np.var(laplacian)
-        
-        # Calculate gradient magnitude
-        sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-        sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-        gradient_mag = np.sqrt(sobelx**2 + sobely**2)
-        gradient_mean = np.mean(gradient_mag)
-        
-        
-        sharpness = laplacian_var * 0.5 + gradient_mean * 0.5
-        
-        return sharpness
+        return image_sharpness(gray)
         
     except Exception as e:
         print(f"Error in measuring sharpness: {str(e)}")
         return -1
 
 
+#function to compute the sharpness of a grayscale image
+def image_sharpness(gray):
+    # Calculate Laplacian
+    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
+    laplacian_var = np.var(laplacian)
+    
+    # Calculate gradient magnitude
+    sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
+    sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
+    gradient_mag = np.sqrt(sobelx**2 + sobely**2)
+    gradient_mean = np.mean(gradient_mag)
+    
+    
+    sharpness = laplacian_var * 0.5 + gradient_mean * 0.5
+    
+    return sharpness
+
+
+#function to estimate the noise standard deviation of a grayscale image (Immerkaer's method)
+def estimate_noise(gray):
+    height, width = gray.shape
+    response = cv2.filter2D(gray.astype(np.float32), -1, NOISE_KERNEL)[1:-1, 1:-1]
+    return np.sqrt(np.pi / 2) * np.abs(response).sum() / (6 * (width - 2) * (height - 2))
+
+
 #function for specialized enhancement on microscopic image
 def enhance_microscope_image(input_path, output_path):
     
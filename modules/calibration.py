@@ -0,0 +1,266 @@
+import cv2
+import numpy as np
+import os
+import json
+import re
+import tempfile
+import time
+
+from modules.progress import no_progress
+
+
+# Calibration profiles are stored as JSON, one file per microscope setup
+PROFILE_FOLDER = 'profiles'
+PROFILE_NAME = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+# Overlaps are downsampled to at most this many pixels before phase correlation
+VERIFY_MAX_SIZE = 512
+
+# Overlaps smaller than this (in full-resolution pixels) are not used for verification
+MIN_OVERLAP_SIZE = 16
+
+# A profile is trusted when every overlap correlates at least this strongly...
+MIN_RESPONSE = 0.05
+
+# ...the stage drift it measures is consistent across tiles within this many pixels...
+MAX_RESIDUAL = 2.0
+
+# ...and no tile moved by more than this fraction of its overlap
+MAX_DRIFT_FRACTION = 0.25
+
+
+#function to check that a profile name is safe to use as a filename
+def valid_profile_name(name):
+    return bool(name) and PROFILE_NAME.match(name) is not None and name not in ('.', '..')
+
+
+#function to load a calibration profile
+def load_profile(name, folder=PROFILE_FOLDER):
+    if not valid_profile_name(name):
+        return None
+    try:
+        with open(os.path.join(folder, f"{name}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+#function to save a calibration profile
+def save_profile(profile, folder=PROFILE_FOLDER):
+    """
+    A profile that cannot be saved only costs the fast path of later scans,
+    so errors are logged rather than raised.
+
+    Returns:
+    - Boolean indicating success
+    """
+    temp_path = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{profile['name']}.json")
+        # A temporary file of its own, so that processes saving the same profile do not collide
+        fd, temp_path = tempfile.mkstemp(prefix=f".{profile['name']}.", suffix='.part', dir=folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(profile, f, indent=2)
+        os.replace(temp_path, path)
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Warning: Could not save calibration profile {profile.get('name')}: {str(e)}")
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+        return False
+
+
+#function to build a profile from the transforms estimated by a successful cv2 stitch
+def profile_from_stitcher(name, stitcher, images, previous=None):
+    """
+    Parameters:
+    - name: Profile name (microscope/objective setup)
+    - stitcher: cv2.Stitcher (SCANS mode) after a successful stitch()
+    - images: The tiles passed to stitch()
+    - previous: The existing profile of this setup, if any
+
+    Returns:
+    - Profile dictionary, or None if the stitcher dropped some tiles
+    """
+    if len(stitcher.component()) != len(images):
+        print("Warning: Not all tiles were stitched, calibration profile not saved")
+        return None
+
+    # In SCANS mode R holds the affine mosaic->tile transform at registration
+    # scale; invert it and rescale the translation to full resolution
+    work_scale = stitcher.workScale()
+    transforms = []
+    for camera in stitcher.cameras():
+        transform = np.linalg.inv(camera.R.astype(np.float64))[:2]
+        transform[:, 2] /= work_scale
+        transforms.append(transform)
+
+    return make_profile(name, images, transforms, previous, fast=False)
+
+
+#function to create or update a profile record
+def make_profile(name, images, transforms, previous=None, fast=False):
+    now = time.time()
+    previous = previous or {}
+    return {
+        'name': name,
+        'tile_sizes': [list(image.shape[:2]) for image in images],
+        'transforms': [np.asarray(t, dtype=np.float64).tolist() for t in transforms],
+        'runs': previous.get('runs', 0) + (0 if fast else 1),
+        'fast_runs': previous.get('fast_runs', 0) + (1 if fast else 0),
+        'created': previous.get('created', now),
+        'updated': now,
+    }
+
+
+#function to get the mosaic-space bounding box of a warped tile
+def _warped_bounds(transform, size):
+    h, w = size
+    corners = np.array([[0, 0], [w, 0], [0, h], [w, h]], dtype=np.float64)
+    warped = corners @ transform[:, :2].T + transform[:, 2]
+    return warped.min(axis=0), warped.max(axis=0)
+
+
+#function to warp the part of a tile that falls inside a mosaic rectangle, downsampled by scale
+def _warp_into(gray, transform, origin, scale, size):
+    shift = np.array([[scale, 0, -scale * origin[0]],
+                      [0, scale, -scale * origin[1]],
+                      [0, 0, 1]])
+    matrix = (shift @ np.vstack([transform, [0, 0, 1]]))[:2]
+    return cv2.warpAffine(gray, matrix, size, flags=cv2.INTER_LINEAR)
+
+
+#function to verify stored transforms against the tiles and correct small stage drift
+def refine_transforms(images, transforms, progress=None):
+    """
+    Measure the misalignment of every overlapping tile pair by phase correlation
+    (no feature detection), then solve for per-tile translation corrections.
+
+    Returns:
+    - (refined transforms, confident flag)
+    """
+    progress = progress or no_progress
+    pairs = len(images) * (len(images) - 1) // 2
+    grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32) for image in images]
+    bounds = [_warped_bounds(t, image.shape[:2]) for t, image in zip(transforms, images)]
+
+    rows = []
+    shifts = []
+    weights = []
+    confident = True
+
+    checked = 0
+    for i in range(len(images)):
+        for j in range(i + 1, len(images)):
+            checked += 1
+            progress('register', method='profile', done=checked, total=pairs)
+            low = np.maximum(bounds[i][0], bounds[j][0])
+            high = np.minimum(bounds[i][1], bounds[j][1])
+            overlap = high - low
+            if overlap.min() < MIN_OVERLAP_SIZE:
+                continue
+
+            scale = min(1.0, VERIFY_MAX_SIZE / overlap.max())
+            size = (max(8, int(overlap[0] * scale)), max(8, int(overlap[1] * scale)))
+            patch_i = _warp_into(grays[i], transforms[i], low, scale, size)
+            patch_j = _warp_into(grays[j], transforms[j], low, scale, size)
+
+            window = cv2.createHanningWindow(size, cv2.CV_32F)
+            (dx, dy), response = cv2.phaseCorrelate(patch_i, patch_j, window)
+            drift = np.array([dx, dy]) / scale
+
+            if response < MIN_RESPONSE or np.any(np.abs(drift) > MAX_DRIFT_FRACTION * overlap):
+                confident = False
+
+            # Tile j's content appears shifted by drift relative to tile i: c_j - c_i = -drift
+            row = np.zeros(len(images))
+            row[i] = -1.0
+            row[j] = 1.0
+            rows.append(row)
+            shifts.append(-drift)
+            weights.append(max(response, 1e-3))
+
+    # Every tile must be constrained by at least one overlap
+    if not rows or np.any(np.abs(np.array(rows)).sum(axis=0) == 0):
+        return transforms, False
+
+    # Anchor the first tile, then solve the weighted least-squares problem
+    anchor = np.zeros(len(images))
+    anchor[0] = 1.0
+    a = np.vstack(rows + [anchor]) * np.sqrt(np.array(weights + [1.0]))[:, None]
+    b = np.vstack(shifts + [np.zeros(2)]) * np.sqrt(np.array(weights + [1.0]))[:, None]
+    corrections, _, _, _ = np.linalg.lstsq(a, b, rcond=None)
+
+    residual = np.abs(np.array(rows) @ corrections - np.array(shifts)).max()
+    if residual > MAX_RESIDUAL:
+        confident = False
+
+    refined = []
+    for transform, correction in zip(transforms, corrections):
+        transform = np.array(transform, dtype=np.float64)
+        transform[:, 2] += correction
+        refined.append(transform)
+    return refined, confident
+
+
+#function to compose a mosaic from tiles and fixed tile->mosaic transforms with feathered blending
+def compose_mosaic(images, transforms, progress=None):
+    progress = progress or no_progress
+    bounds = [_warped_bounds(t, image.shape[:2]) for t, image in zip(transforms, images)]
+    origin = np.floor(np.min([low for low, _ in bounds], axis=0))
+    end = np.ceil(np.max([high for _, high in bounds], axis=0))
+    width, height = (end - origin).astype(int)
+
+    accumulated = np.zeros((height, width, 3), dtype=np.float32)
+    total_weight = np.zeros((height, width), dtype=np.float32)
+
+    for index, (image, transform, (low, high)) in enumerate(zip(images, transforms, bounds)):
+        h, w = image.shape[:2]
+
+        # Only warp into the tile's own footprint on the canvas
+        x0, y0 = (np.floor(low) - origin).astype(int)
+        x1, y1 = np.minimum((np.ceil(high) - origin).astype(int), (width, height))
+        matrix = np.array(transform, dtype=np.float64)
+        matrix[:, 2] -= origin + (x0, y0)
+
+        # Weights fall off linearly towards the tile borders
+        ramp_x = np.minimum(np.arange(1, w + 1), np.arange(w, 0, -1)).astype(np.float32)
+        ramp_y = np.minimum(np.arange(1, h + 1), np.arange(h, 0, -1)).astype(np.float32)
+        weight = np.minimum.outer(ramp_y, ramp_x)
+
+        size = (x1 - x0, y1 - y0)
+        warped = cv2.warpAffine(image, matrix, size, flags=cv2.INTER_LINEAR).astype(np.float32)
+        warped_weight = cv2.warpAffine(weight, matrix, size, flags=cv2.INTER_LINEAR)
+
+        accumulated[y0:y1, x0:x1] += warped * warped_weight[:, :, None]
+        total_weight[y0:y1, x0:x1] += warped_weight
+        progress('blend', percent=round(100.0 * (index + 1) / len(images), 1))
+
+    # Pixels outside every tile have zero weight and stay black
+    mosaic = cv2.divide(accumulated, cv2.merge([total_weight] * 3))
+    return cv2.convertScaleAbs(mosaic)
+
+
+#function for the calibrated fast path: stitch with a profile's transforms, skipping feature detection
+def stitch_with_profile(images, profile, progress=None):
+    """
+    Returns:
+    - (mosaic, updated profile), or (None, None) when the profile does not
+      match these tiles or is not confident enough
+    """
+    if [list(image.shape[:2]) for image in images] != profile.get('tile_sizes'):
+        print(f"Calibration profile {profile.get('name')} does not match the tiles")
+        return None, None
+
+    transforms = [np.array(t, dtype=np.float64) for t in profile['transforms']]
+    transforms, confident = refine_transforms(images, transforms, progress)
+    if not confident:
+        print(f"Calibration profile {profile['name']} is not confident for these tiles")
+        return None, None
+
+    mosaic = compose_mosaic(images, transforms, progress)
+    return mosaic, make_profile(profile['name'], images, transforms, profile, fast=True)
@@ -0,0 +1,98 @@
+import cv2
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# The format table and pending-artifact registry live in modules/outputs.py
+# (no OpenCV); imported here too for the encoding side
+from modules.outputs import OUTPUT_FORMATS, DEFAULT_OUTPUT_FORMAT, output_format_of, track_pending, wait_for_output
+
+
+# Encoder quality of lossy formats when none is requested
+DEFAULT_QUALITY = 95
+
+# Previews are small JPEGs returned before the full-quality artifact is ready
+PREVIEW_MAX_SIZE = 512
+PREVIEW_QUALITY = 70
+
+# Encoding runs on a small worker pool (OpenCV releases the GIL while encoding)
+ENCODER_WORKERS = max(2, (os.cpu_count() or 2) // 2)
+
+_encoder = ThreadPoolExecutor(max_workers=ENCODER_WORKERS, thread_name_prefix='encoder')
+
+
+#function to build the cv2 encoder parameters for a format and quality
+def encode_params(output_format, quality=None):
+    if quality is None:
+        quality = DEFAULT_QUALITY
+
+    if output_format == 'jpg':
+        return [cv2.IMWRITE_JPEG_QUALITY, int(quality), cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    if output_format == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    if output_format == 'png':
+        # Lossless: quality is ignored, favour fast compression
+        return [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    if output_format == 'tiff':
+        # Lossless LZW compression, suitable for quantitative analysis
+        return [cv2.IMWRITE_TIFF_COMPRESSION, 5]
+    return []
+
+
+#function to encode an image and write it atomically to disk
+def encode_image(output_path, image, quality=None):
+    # Write to a temporary file first so that readers never see a partial image;
+    # other processes wait for the artifact while the temporary file exists
+    temp_path = f"{output_path}.part"
+    try:
+        output_format = output_format_of(output_path)
+        ok, buffer = cv2.imencode(f'.{output_format}', image, encode_params(output_format, quality))
+        if not ok:
+            print(f"Error: Failed to encode image for {output_path}")
+            return False
+
+        with open(temp_path, 'wb') as f:
+            f.write(buffer.tobytes())
+        os.replace(temp_path, output_path)
+        return True
+    finally:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+
+#function to write a small JPEG preview of an image
+def write_preview(preview_path, image):
+    height, width = image.shape[:2]
+    scale = PREVIEW_MAX_SIZE / max(height, width)
+    if scale < 1.0:
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return encode_image(preview_path, image, PREVIEW_QUALITY)
+
+
+#function to encode an output in the encoder pool, optionally returning after a preview is written
+def write_image(output_path, image, quality=None, preview_path=None):
+    """
+    Encode an image to output_path (format taken from its extension).
+
+    Parameters:
+    - output_path: Path of the full-quality artifact
+    - image: Image to encode
+    - quality: Encoder quality 1-100 for lossy formats (ignored for png/tiff)
+    - preview_path: If given, a small JPEG preview is written and the call returns
+      while the full-quality artifact is still being encoded in the background
+
+    Returns:
+    - Boolean indicating success (or successful scheduling when previewing)
+    """
+    # Mark the artifact as pending before returning, for requests served by other processes
+    open(f"{output_path}.part", 'wb').close()
+    future = _encoder.submit(encode_image, output_path, image, quality)
+    track_pending(output_path, future)
+
+    if preview_path is not None:
+        return write_preview(preview_path, image)
+
+    return future.result()
+
@@ -0,0 +1,352 @@
+import json
+import os
+import re
+import signal
+import threading
+import time
+import uuid
+
+from modules import shm_store, workers
+from modules.outputs import wait_for_output
+from modules.storage import hold
+
+
+# Each job runs in its own process, which reports progress events back to the
+# server process that started it. Cancelling a job terminates its process, so
+# the CPU and the job slot are released immediately.
+JOB_CONTEXT = workers.PROCESS_CONTEXT
+
+# Job state lives in files, so that any server process (gunicorn worker) can
+# report, stream or cancel a job started by another one:
+#   <id>.json    status, written by the server process that owns the job
+#   <id>.events  progress events, one JSON object per line
+#   <id>.cancel  created to cancel the job
+JOB_FOLDER = os.environ.get('MICROIMAGE_JOB_FOLDER') or os.path.join(shm_store.SHM_ROOT, 'microimage_jobs')
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# Seconds between checks for new events of a job
+POLL_INTERVAL_SECONDS = 0.2
+
+# Seconds a cancelled job gets to exit after SIGTERM before it is killed
+CANCEL_GRACE_SECONDS = 2
+
+# Finished jobs (and their events) are forgotten after this many seconds
+JOB_RETENTION_SECONDS = 60 * 60
+
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+
+class Job:
+    """
+    A long-running operation and the progress events it has reported.
+
+    States: queued (waiting for a job slot), running, then done, failed or
+    cancelled. Every event carries a sequence number ('seq') so that a client
+    can resume an event stream where it left off.
+    """
+
+    def __init__(self, job_id, folder=JOB_FOLDER):
+        self.id = job_id
+        self._base = os.path.join(folder, job_id)
+        self._events_written = 0
+
+    #function to create the files of a new job owned by this process
+    @classmethod
+    def create(cls, kind, folder=JOB_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        job = cls(uuid.uuid4().hex, folder)
+        open(f"{job._base}.events", 'w').close()
+        job._write_status({
+            'job_id': job.id,
+            'kind': kind,
+            'status': 'queued',
+            'owner_pid': os.getpid(),
+            'pid': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+        })
+        return job
+
+    def _read_status(self):
+        try:
+            with open(f"{self._base}.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_status(self, status):
+        with open(f"{self._base}.json.part", 'w') as f:
+            json.dump(status, f)
+        os.replace(f"{self._base}.json.part", f"{self._base}.json")
+
+    def _update_status(self, **changes):
+        status = self._read_status()
+        if status is None or status['status'] in FINAL_STATES:
+            return False
+        status.update(changes)
+        if changes.get('status') in FINAL_STATES:
+            status['finished'] = time.time()
+        self._write_status(status)
+        return True
+
+    #function to append a progress event (owning process only)
+    def publish(self, event):
+        event = dict(event, seq=self._events_written, time=time.time())
+        with open(f"{self._base}.events", 'a') as f:
+            f.write(json.dumps(event) + '\n')
+        self._events_written += 1
+
+    def _read_events(self):
+        try:
+            with open(f"{self._base}.events") as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        # A line without its newline is still being written
+        return [json.loads(line) for line in lines if line.endswith('\n')]
+
+    def cancel_requested(self):
+        return os.path.exists(f"{self._base}.cancel")
+
+    #function to wait for events after position (or for the end of the job)
+    def wait_events(self, position, timeout):
+        """
+        Returns:
+        - (new events, finished flag)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            finished = self.snapshot()['status'] in FINAL_STATES
+            events = self._read_events()[position:]
+            if events or finished or time.monotonic() >= deadline:
+                return events, finished
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+    #function to describe the job as a JSON-serialisable dictionary
+    def snapshot(self):
+        status = self._read_status() or {'job_id': self.id, 'status': 'failed', 'error': 'Job state lost'}
+        owner_pid = status.pop('owner_pid', None)
+        status.pop('pid', None)
+
+        if self.cancel_requested():
+            if status['status'] != 'cancelled':
+                status.pop('result', None)
+                status['status'] = 'cancelled'
+                status['finished'] = status.get('finished') or os.path.getmtime(f"{self._base}.cancel")
+        elif status['status'] not in FINAL_STATES and not _process_exists(owner_pid):
+            # The server process that ran the job is gone
+            status['status'] = 'failed'
+            status['error'] = 'The server process running the job exited'
+
+        events = self._read_events()
+        status['progress'] = events[-1] if events else None
+        return status
+
+    def _remove(self):
+        for suffix in ('.json', '.events', '.cancel'):
+            try:
+                os.remove(f"{self._base}{suffix}")
+            except FileNotFoundError:
+                pass
+
+
+def _process_exists(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user, so it is alive
+        return True
+    return True
+
+
+#function to run a job in its own process, reporting progress and the result through a pipe
+def _run_job(target, kwargs, connection, segment_directory):
+    workers.init_process(segment_directory)
+    workers.run_inline()
+
+    def progress(stage, **details):
+        connection.send(('progress', dict(details, stage=stage)))
+
+    try:
+        result = target(progress=progress, **kwargs)
+        # Results encoded in the background must be complete before the process exits
+        if kwargs.get('output_path'):
+            wait_for_output(kwargs['output_path'])
+        connection.send(('result', result))
+    except Exception as e:
+        connection.send(('error', str(e)))
+    finally:
+        connection.close()
+
+
+#function to start a job that calls target(progress=..., **kwargs) in a new process
+def start_job(kind, target, kwargs, slots=None, hold_paths=(), output_paths=(),
+              on_success=None, error_message=None, segment_tag=None):
+    """
+    Parameters:
+    - kind: Name of the operation (e.g. 'stitch')
+    - target: Module-level function to run (must accept a progress callback)
+    - kwargs: Keyword arguments of target
+    - slots: Optional semaphore limiting how many jobs run at once
+    - hold_paths: Input files kept from eviction while the job runs
+    - output_paths: Files written by the job, removed if it is cancelled
+    - on_success: Optional function called with target's return value; returns
+      the result dictionary of the job
+    - error_message: Error reported when target returns None or False
+    - segment_tag: Tag of the shared-memory segments the job creates; they
+      are freed when the job ends, even if it was cancelled
+
+    Returns:
+    - Job
+    """
+    _forget_finished_jobs()
+    job = Job.create(kind)
+
+    thread = threading.Thread(target=_supervise,
+                              args=(job, target, kwargs, slots, hold_paths, output_paths,
+                                    on_success, error_message, segment_tag),
+                              name=f"job-{job.id}", daemon=True)
+    thread.start()
+    return job
+
+
+def _supervise(job, target, kwargs, slots, hold_paths, output_paths, on_success, error_message,
+               segment_tag):
+    if slots is not None:
+        slots.acquire()
+    try:
+        with hold(*hold_paths):
+            _run_supervised(job, target, kwargs, output_paths, on_success, error_message)
+    except Exception as e:
+        print(f"Error in job {job.id}: {str(e)}")
+        job._update_status(status='failed', error=str(e))
+    finally:
+        if segment_tag is not None:
+            shm_store.release_all(segment_tag)
+        if slots is not None:
+            slots.release()
+
+
+def _run_supervised(job, target, kwargs, output_paths, on_success, error_message):
+    # Do not start a job that was cancelled while it was queued
+    if job.cancel_requested():
+        job._update_status(status='cancelled')
+        return
+
+    receiver, sender = JOB_CONTEXT.Pipe(duplex=False)
+    process = JOB_CONTEXT.Process(target=_run_job,
+                                  args=(target, kwargs, sender, shm_store.segment_directory()),
+                                  name=f"job-{job.id}", daemon=True)
+    process.start()
+    sender.close()
+    job._update_status(status='running', pid=process.pid, started=time.time())
+
+    # Cancelled between the check above and the start of the process
+    if job.cancel_requested():
+        _terminate(process.pid)
+
+    result = None
+    error = None
+    while True:
+        try:
+            kind, payload = receiver.recv()
+        except (EOFError, OSError):
+            # The process has exited (or was terminated)
+            break
+        if kind == 'progress':
+            job.publish(payload)
+        elif kind == 'result':
+            result = payload
+        elif kind == 'error':
+            error = payload
+    receiver.close()
+    process.join()
+
+    if job.cancel_requested():
+        _remove_outputs(output_paths)
+        job._update_status(status='cancelled')
+    elif error is not None:
+        job._update_status(status='failed', error=error)
+    elif result is None or result is False:
+        job._update_status(status='failed', error=error_message or 'Job failed')
+    else:
+        details = on_success(result) if on_success is not None else {}
+        job._update_status(status='done', result=details)
+
+
+def _remove_outputs(paths):
+    for path in paths:
+        if not path:
+            continue
+        for candidate in (path, f"{path}.part"):
+            try:
+                os.remove(candidate)
+            except FileNotFoundError:
+                pass
+
+
+#function to terminate a job process, killing it if it does not exit in time
+def _terminate(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + CANCEL_GRACE_SECONDS
+    while time.monotonic() < deadline:
+        if not _process_exists(pid):
+            return
+        time.sleep(0.05)
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+#function to look up a job by id (in any server process)
+def get_job(job_id):
+    if not JOB_ID.match(job_id or ''):
+        return None
+    job = Job(job_id)
+    if job._read_status() is None:
+        return None
+    return job
+
+
+#function to cancel a queued or running job, terminating its process
+def cancel_job(job_id):
+    """
+    Returns:
+    - The job, or None if there is no such job
+    """
+    job = get_job(job_id)
+    if job is None:
+        return None
+    if job.snapshot()['status'] in FINAL_STATES:
+        return job
+
+    open(f"{job._base}.cancel", 'w').close()
+    # The owning server process finishes the cancellation once the process is gone
+    pid = job._read_status().get('pid')
+    if pid:
+        _terminate(pid)
+    return job
+
+
+def _forget_finished_jobs():
+    try:
+        names = os.listdir(JOB_FOLDER)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        job = Job(name[:-len('.json')])
+        snapshot = job.snapshot()
+        if snapshot['status'] in FINAL_STATES and now - (snapshot.get('finished') or 0) > JOB_RETENTION_SECONDS:
+            job._remove()
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+
+
+# Output formats and the pending-artifact registry. Kept apart from
+# modules/encoding.py (which loads OpenCV) so that the web server can
+# validate formats and wait for artifacts without loading the image stack.
+
+# Supported output formats (file extension -> canonical extension)
+OUTPUT_FORMATS = {
+    'jpg': 'jpg',
+    'jpeg': 'jpg',
+    'png': 'png',
+    'webp': 'webp',
+    'tif': 'tiff',
+    'tiff': 'tiff',
+}
+DEFAULT_OUTPUT_FORMAT = 'jpg'
+
+# Seconds a request for a pending artifact waits for its encoder to finish
+PENDING_WAIT_TIMEOUT = 120
+
+# Seconds between checks for an artifact being encoded by another process
+PENDING_POLL_SECONDS = 0.05
+
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+#function to get the canonical output format of a path from its extension
+def output_format_of(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return OUTPUT_FORMATS.get(extension, DEFAULT_OUTPUT_FORMAT)
+
+
+#function to mark an artifact as pending until its encoder future is done
+def track_pending(output_path, future):
+    key = os.path.abspath(output_path)
+    with _pending_lock:
+        _pending[key] = future
+    future.add_done_callback(lambda _: _forget_pending(key, future))
+
+
+def _forget_pending(key, future):
+    with _pending_lock:
+        if _pending.get(key) is future:
+            del _pending[key]
+
+
+#function to wait until a background-encoded artifact has been written (by any process); False if it is not ready in time
+def wait_for_output(path, timeout=PENDING_WAIT_TIMEOUT):
+    with _pending_lock:
+        future = _pending.get(os.path.abspath(path))
+    if future is not None:
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            return False
+        except Exception as e:
+            print(f"Error while waiting for {path}: {str(e)}")
+            return False
+
+    # Encoded by another process: wait while its temporary file exists
+    temp_path = f"{path}.part"
+    if not os.path.exists(temp_path):
+        return True
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # A temporary file this old was left by a process that died while encoding
+            if time.time() - os.path.getmtime(temp_path) > timeout:
+                break
+        except FileNotFoundError:
+            return os.path.exists(path)
+        time.sleep(PENDING_POLL_SECONDS)
+    return False
@@ -0,0 +1,150 @@
+import time
+import uuid
+
+from modules import shm_store, workers
+from modules.progress import timed_stage
+from modules.encoding import write_image
+from modules.stitch import read_tile, read_tiles, stitch_tiles
+from modules.roi import crop_roi
+from modules.zoom import build_pyramid, render_zoom, zoom_level
+from modules.autofocus import enhance_focus, enhance_focus_adaptive
+
+
+# Stages run in worker processes. Each takes and returns shared-memory
+# handles, so an image is decoded once and never pickled or re-encoded
+# between stages.
+
+#function to decode a single image into shared memory
+def load_stage(image_path, tag=None, progress=None):
+    image = read_tile(image_path)
+    if image is None:
+        return None
+    return shm_store.put_image(image, tag)
+
+
+#function to stitch tiles into shared memory
+def stitch_stage(image_paths, profile=None, tag=None, progress=None):
+    images = read_tiles(image_paths, progress)
+    if len(images) < 2:
+        print("Error: At least 2 valid images are required for stitching")
+        return None
+
+    stitched = stitch_tiles(images, profile, progress)
+    if stitched is None:
+        return None
+    return shm_store.put_image(stitched, tag)
+
+
+#function to render a zoomed view of an image in shared memory
+def zoom_stage(handle, zoom_factor=1.0, center_x=None, center_y=None,
+               max_width=1024, max_height=1024, tag=None, progress=None):
+    image = shm_store.get_image(handle)
+    # Build only the levels the view is resampled from: none beyond the
+    # image itself when zooming into an ROI
+    height, width = image.shape[:2]
+    levels = build_pyramid(image, max_level=zoom_level(width, height, zoom_factor, max_width, max_height))
+    zoomed, _ = render_zoom(levels, zoom_factor, center_x, center_y, max_width, max_height)
+    return shm_store.put_image(zoomed, tag)
+
+
+#function to enhance the focus of an image in shared memory
+def focus_stage(handle, adaptive=False, tag=None, progress=None):
+    image = shm_store.get_image(handle)
+    if adaptive:
+        enhanced, report = enhance_focus_adaptive(image, progress)
+    else:
+        enhanced, report = enhance_focus(image, progress=progress), None
+
+    # An image that needed no enhancement is passed on as it is
+    if enhanced is image:
+        return handle, report
+    return shm_store.put_image(enhanced, tag), report
+
+
+#function to run stitch/load -> ROI -> zoom -> auto-focus, passing images between workers by handle
+def run_pipeline(image_paths, output_path, profile=None, roi=None, zoom=None, focus=None,
+                 quality=None, preview_path=None, progress=None, tag=None):
+    """
+    Parameters:
+    - image_paths: Tiles to stitch, or a single image to start from
+    - output_path: Path of the final image (format taken from its extension)
+    - profile: Optional calibration profile name used for stitching
+    - roi: Optional (x, y, width, height) to crop
+    - zoom: Optional dictionary of zoom options (zoom_factor, center_x, center_y,
+      max_width, max_height)
+    - focus: None, 'standard' or 'adaptive'
+    - quality, preview_path: Output options, as for the single operations
+    - progress: Optional progress callback (stage timings; step details when the
+      stages run in this process, i.e. in a job process)
+    - tag: Optional name for the shared-memory segments of this run (default: random)
+
+    Returns:
+    - Dictionary with the stages run, their timings, the output size and the
+      focus report (adaptive focus only), or None on failure
+    """
+    # Every segment of this run carries the tag, so all of them are freed at the end
+    tag = tag or uuid.uuid4().hex
+    timings = {}
+    report = None
+
+    try:
+        started = time.perf_counter()
+        stages = ['stitch' if len(image_paths) > 1 else 'load']
+        with timed_stage(progress, stages[0]):
+            if len(image_paths) > 1:
+                handle = workers.run(stitch_stage, image_paths, profile, tag, progress=progress)
+            else:
+                handle = workers.run(load_stage, image_paths[0], tag, progress=progress)
+        if handle is None:
+            print("Error: Failed to load the pipeline input")
+            return None
+        timings[stages[0]] = time.perf_counter() - started
+
+        if roi is not None:
+            # Cropping only moves the window into the segment: no worker, no copy
+            started = time.perf_counter()
+            image = shm_store.get_image(handle)
+            handle = shm_store.share_view(handle, image, crop_roi(image, *roi))
+            stages.append('roi')
+            timings['roi'] = time.perf_counter() - started
+
+        if zoom is not None:
+            started = time.perf_counter()
+            with timed_stage(progress, 'zoom'):
+                handle = workers.run(zoom_stage, handle, tag=tag, progress=progress, **zoom)
+            stages.append('zoom')
+            timings['zoom'] = time.perf_counter() - started
+
+        if focus is not None:
+            started = time.perf_counter()
+            with timed_stage(progress, 'focus'):
+                handle, report = workers.run(focus_stage, handle, focus == 'adaptive', tag, progress=progress)
+            stages.append('focus')
+            timings['focus'] = time.perf_counter() - started
+
+        # The encoder reads the final image straight from shared memory; its
+        # mapping outlives the release of the segment below
+        started = time.perf_counter()
+        result = shm_store.get_image(handle)
+        with timed_stage(progress, 'encode'):
+            saved = write_image(output_path, result, quality, preview_path)
+        if not saved:
+            print(f"Error: Failed to save pipeline result to {output_path}")
+            return None
+        timings['encode'] = time.perf_counter() - started
+
+        print(f"Pipeline {' -> '.join(stages)} saved to {output_path}")
+        return {
+            'stages': stages,
+            'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()},
+            'width': result.shape[1],
+            'height': result.shape[0],
+            'focus_report': report,
+        }
+
+    except Exception as e:
+        print(f"Error in processing pipeline: {str(e)}")
+        return None
+
+    finally:
+        shm_store.release_all(tag)
@@ -0,0 +1,40 @@
+import time
+from contextlib import contextmanager
+
+
+# Long operations accept an optional progress(stage, **details) callback.
+# Details are JSON-serialisable, e.g. progress('decode', done=3, total=8) or
+# progress('blend', percent=50.0).
+
+#function used when the caller does not want progress reports
+def no_progress(stage, **details):
+    pass
+
+
+#function to report the start and the duration of a stage
+@contextmanager
+def timed_stage(progress, stage, **details):
+    progress = progress or no_progress
+    started = time.perf_counter()
+    progress(stage, status='started', **details)
+    yield
+    progress(stage, status='finished', elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+
+
+class StepTimer:
+    """
+    Reports the numbered steps of a stage, each with the time since the
+    previous step (or since the timer was created).
+    """
+
+    def __init__(self, progress, stage, steps):
+        self.progress = progress or no_progress
+        self.stage = stage
+        self.steps = steps
+        self._last = time.perf_counter()
+
+    def done(self, step, name):
+        now = time.perf_counter()
+        self.progress(self.stage, step=step, steps=self.steps, name=name,
+                      elapsed_ms=round((now - self._last) * 1000, 1))
+        self._last = now
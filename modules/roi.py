@@ -2,8 +2,10 @@ import cv2
 import numpy as np
 import os
 
+from modules.encoding import write_image
+
 #function for Extract a Region of Interest (ROI) from an image.
-def roi_select(input_path, output_path, x, y, width, height):
+def roi_select(input_path, output_path, x, y, width, height, quality=None, preview_path=None):
     try:
         # Check if the input image exists
         if not os.path.exists(input_path):
@@ -17,27 +19,11 @@ def roi_select(input_path, output_path, x, y, width, height):
             print(f"Error: Failed to read image {input_path}")
             return False
         
-        # Get image dimensions
-        img_height, img_width = image.shape[:2]
-        
-        # Validate ROI coordinates
-        if x < 0 or y < 0 or x + width > img_width or y + height > img_height:
-            print("Error: ROI coordinates are outside image boundaries")
-            # Adjust ROI to fit within image boundaries
-            x = max(0, min(x, img_width - 1))
-            y = max(0, min(y, img_height - 1))
-            width = min(width, img_width - x)
-            height = min(height, img_height - y)
-            print(f"Adjusted ROI to: x={x}, y={y}, width={width}, height={height}")
-        
         # Extract ROI
-        roi = image[y:y+height, x:x+width]
+        roi = crop_roi(image, x, y, width, height)
         
         # Save ROI to output path
-        cv2.imwrite(output_path, roi)
-        
-        # Validate if file was created
-        if os.path.exists(output_path):
+        if write_image(output_path, roi, quality, preview_path):
             print(f"ROI extracted and saved to {output_path}")
             return True
         else:
@@ -50,6 +36,25 @@ def roi_select(input_path, output_path, x, y, width, height):
 
 
 
+#function to crop a Region of Interest (ROI) from an image array, clamped to its boundaries (a view, not a copy)
+def crop_roi(image, x, y, width, height):
+    # Get image dimensions
+    img_height, img_width = image.shape[:2]
+    
+    # Validate ROI coordinates
+    if x < 0 or y < 0 or x + width > img_width or y + height > img_height:
+        print("Error: ROI coordinates are outside image boundaries")
+        # Adjust ROI to fit within image boundaries
+        x = max(0, min(x, img_width - 1))
+        y = max(0, min(y, img_height - 1))
+        width = min(width, img_width - x)
+        height = min(height, img_height - y)
+        print(f"Adjusted ROI to: x={x}, y={y}, width={width}, height={height}")
+    
+    return image[y:y+height, x:x+width]
+
+
+
 #function for highlight a Region of Interest (ROI) in an image.
 def highlight_roi(input_path, output_path, x, y, width, height):
     try:
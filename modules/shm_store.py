@@ -0,0 +1,187 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import namedtuple
+
+# numpy is imported by the functions that build arrays: the web server itself
+# only manages segment files and starts without it
+
+# Segments are files on a RAM-backed filesystem (tmpfs) mapped into every
+# process that uses them, so images are shared between processes without
+# pickling or re-encoding
+SHM_ROOT = os.environ.get('MICROIMAGE_SHM_ROOT') or (
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+# Each owning process keeps its segments in SHM_ROOT/microimage-<pid>
+SEGMENT_PREFIX = 'microimage-'
+
+# A handle describes an array inside a segment. Handles are small and
+# picklable; views (e.g. an ROI) share the segment of their base image.
+ImageHandle = namedtuple('ImageHandle', ['path', 'shape', 'dtype', 'offset', 'strides'])
+
+_directory = None
+_directory_pid = None
+_directory_lock = threading.Lock()
+
+
+#function to get the segment directory of this process, creating it on first use
+def segment_directory():
+    """
+    The process that creates the directory owns it: the directory is removed
+    when that process exits, and directories left by owners that died without
+    cleaning up are removed the next time a directory is created.
+    """
+    global _directory, _directory_pid
+    with _directory_lock:
+        # A forked child does not inherit the directory of its parent
+        if _directory is None or _directory_pid != os.getpid():
+            sweep_orphans()
+            directory = os.path.join(SHM_ROOT, f"{SEGMENT_PREFIX}{os.getpid()}")
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(shutil.rmtree, directory, True)
+            _directory = directory
+            _directory_pid = os.getpid()
+        return _directory
+
+
+#function to create segments in another process's directory (used by worker processes)
+def attach_directory(directory):
+    global _directory, _directory_pid
+    with _directory_lock:
+        _directory = directory
+        _directory_pid = os.getpid()
+
+
+#function to remove the segment directories of processes that no longer exist
+def sweep_orphans():
+    try:
+        names = os.listdir(SHM_ROOT)
+    except OSError:
+        return 0
+
+    removed = 0
+    for name in names:
+        if not name.startswith(SEGMENT_PREFIX):
+            continue
+        try:
+            pid = int(name[len(SEGMENT_PREFIX):])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _process_exists(pid):
+            continue
+        shutil.rmtree(os.path.join(SHM_ROOT, name), ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user, so it is alive
+        return True
+    return True
+
+
+#function to allocate an image in a new segment, returning its handle and a writable view
+def allocate_image(shape, dtype='uint8', tag=None):
+    """
+    Parameters:
+    - shape: Array shape (e.g. (height, width, 3))
+    - dtype: Array dtype
+    - tag: Optional name prefix (e.g. a job id) so that release_all() can
+      free every segment of a job, including ones whose handle was lost
+
+    Returns:
+    - (ImageHandle, numpy array backed by the segment)
+    """
+    import numpy as np
+    dtype = np.dtype(dtype)
+    name = f"{tag}-{uuid.uuid4().hex}" if tag else uuid.uuid4().hex
+    path = os.path.join(segment_directory(), name)
+
+    array = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+    handle = ImageHandle(path, array.shape, dtype.str, 0, array.strides)
+    return handle, array
+
+
+#function to copy an image into a new segment
+def put_image(image, tag=None):
+    import numpy as np
+    handle, array = allocate_image(image.shape, image.dtype, tag)
+    np.copyto(array, image)
+    return handle
+
+
+#function to map the image of a handle without copying it
+def get_image(handle):
+    """
+    The array is mapped copy-on-write: it can be read (and even modified) like
+    any other array, but changes never reach the segment, so the image a
+    handle refers to stays the same for every reader.
+
+    The mapping stays valid after the segment is released, for as long as the
+    array (or a view of it) is alive.
+    """
+    import numpy as np
+    segment = np.memmap(handle.path, dtype=np.uint8, mode='c')
+    return np.ndarray(handle.shape, np.dtype(handle.dtype), buffer=segment,
+                      offset=handle.offset, strides=handle.strides)
+
+
+#function to get a handle for a view (e.g. an ROI crop) of a mapped image, sharing its segment
+def share_view(handle, image, view):
+    """
+    Parameters:
+    - handle: Handle of the segment image was mapped from
+    - image: Array returned by get_image(handle)
+    - view: A view of image (basic slicing only)
+    """
+    import numpy as np
+    offset = view.__array_interface__['data'][0] - image.__array_interface__['data'][0]
+    if not np.shares_memory(image, view) or offset < 0:
+        raise ValueError('view does not belong to the mapped image')
+    return ImageHandle(handle.path, view.shape, view.dtype.str, handle.offset + offset, view.strides)
+
+
+#function to free a segment (views of it are freed too); mapped arrays stay usable
+def release(handle):
+    try:
+        os.remove(handle.path)
+    except FileNotFoundError:
+        pass
+
+
+#function to free every segment created with a tag
+def release_all(tag):
+    directory = segment_directory()
+    removed = 0
+    for name in os.listdir(directory):
+        if name.startswith(f"{tag}-"):
+            try:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+#function to report the segments currently held by this process
+def stats():
+    directory = segment_directory()
+    sizes = []
+    for entry in os.scandir(directory):
+        try:
+            sizes.append(entry.stat().st_size)
+        except FileNotFoundError:
+            pass
+    return {
+        'directory': directory,
+        'segments': len(sizes),
+        'bytes': sum(sizes),
+    }
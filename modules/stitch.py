@@ -54,16 +54,64 @@
 import cv2
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.encoding import write_image
+from modules.calibration import load_profile, save_profile, profile_from_stitcher, stitch_with_profile
+from modules.progress import no_progress, timed_stage
+
+
+# Tiles are decoded and their features extracted concurrently
+# (OpenCV releases the GIL in imread, cvtColor and detectAndCompute)
+TILE_WORKERS = int(os.environ.get('MICROIMAGE_TILE_WORKERS', min(16, os.cpu_count() or 4)))
+
+_tile_pool = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix='tiles')
+
+
+#function to read a single tile
+def read_tile(path):
+    if not os.path.exists(path):
+        print(f"Warning: Image {path} does not exist")
+        return None
+    img = cv2.imread(path)
+    if img is None:
+        print(f"Warning: Could not read image {path}")
+    return img
+
+
+#function to read all tiles concurrently, skipping the ones that cannot be read
+def read_tiles(image_paths, progress=None):
+    progress = progress or no_progress
+    futures = [_tile_pool.submit(read_tile, path) for path in image_paths]
+    images = []
+    for done, future in enumerate(futures, 1):
+        images.append(future.result())
+        progress('decode', done=done, total=len(futures))
+    return [img for img in images if img is not None]
+
+
+#function to detect ORB features of a tile
+def detect_features(img):
+    # ORB detectors are not thread-safe, so each task creates its own
+    detector = cv2.ORB_create(nfeatures=2000)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return detector.detectAndCompute(gray, None)
 
 
 #function for stitching images
-def stitched_images(image_paths, output_path):
+def stitched_images(image_paths, output_path, quality=None, preview_path=None, profile=None, progress=None):
     """
     Stitch multiple microscope images into one seamless high-resolution image.
     
     Parameters:
     - image_paths: List of paths to the input images
-    - output_path: Path to save the stitched output image
+    - output_path: Path to save the stitched output image (format taken from its extension)
+    - quality: Encoder quality 1-100 for lossy output formats
+    - preview_path: Optional path for a low-resolution preview written before the full image
+    - profile: Optional calibration profile name of the microscope setup. A confident
+      profile skips feature detection; a full stitch creates or updates the profile
+    - progress: Optional progress callback (tiles decoded, pairs registered,
+      blending percentage and stage timings)
     
     Returns:
     - Boolean indicating success or failure
@@ -75,38 +123,23 @@ def stitched_images(image_paths, output_path):
             return False
         
         # Read all images
-        images = []
-        for path in image_paths:
-            if os.path.exists(path):
-                img = cv2.imread(path)
-                if img is not None:
-                    images.append(img)
-                else:
-                    print(f"Warning: Could not read image {path}")
-            else:
-                print(f"Warning: Image {path} does not exist")
+        with timed_stage(progress, 'decode'):
+            images = read_tiles(image_paths, progress)
         
         if len(images) < 2:
             print("Error: At least 2 valid images are required for stitching")
             return False
         
-        # Create a stitcher object
-        stitcher = cv2.Stitcher_create(cv2.Stitcher_SCANS)
-        
-        # Perform stitching
-        status, stitched_img = stitcher.stitch(images)
-        
-        if status != cv2.Stitcher_OK:
-            # If automatic stitching fails, try a feature-based approach
-            print("Automatic stitching failed, trying feature-based approach...")
-            stitched_img = feature_based_stitching(images)
-            
-            if stitched_img is None:
-                print(f"Error: Image stitching failed with status {status}")
-                return False
+        stitched_img = stitch_tiles(images, profile, progress)
+        if stitched_img is None:
+            return False
         
         # Save the result
-        cv2.imwrite(output_path, stitched_img)
+        with timed_stage(progress, 'encode'):
+            saved = write_image(output_path, stitched_img, quality, preview_path)
+        if not saved:
+            print(f"Error: Failed to save stitched image to {output_path}")
+            return False
         print(f"Stitched image saved to {output_path}")
         return True
         
@@ -115,24 +148,65 @@ def stitched_images(image_paths, output_path):
         return False
 
 
-#function to create feature-based stitching using ORB
-def feature_based_stitching(images):
-    try:
-        # Define feature detector
-        detector = cv2.ORB_create(nfeatures=2000)
+#function to stitch decoded tiles into one image
+def stitch_tiles(images, profile=None, progress=None):
+    """
+    Stitch tiles with the calibrated fast path, cv2.Stitcher or the
+    feature-based fallback, in that order.
+    
+    Returns:
+    - Stitched image, or None if stitching fails
+    """
+    # Fast path: reuse the calibrated tile transforms of this setup
+    calibration = load_profile(profile) if profile else None
+    stitched_img = None
+    if calibration is not None:
+        with timed_stage(progress, 'calibrated', profile=profile):
+            stitched_img, updated = stitch_with_profile(images, calibration, progress)
+        if stitched_img is not None:
+            save_profile(updated)
+            print(f"Stitched with calibration profile {profile}")
+    
+    if stitched_img is not None:
+        status = cv2.Stitcher_OK
+    else:
+        # Create a stitcher object
+        stitcher = cv2.Stitcher_create(cv2.Stitcher_SCANS)
         
-        # Detect features in all images
-        keypoints = []
-        descriptors = []
+        # Perform stitching: stitch() in two steps, so that each can be reported
+        with timed_stage(progress, 'register', method='stitcher'):
+            status = stitcher.estimateTransform(images)
+        if status == cv2.Stitcher_OK:
+            with timed_stage(progress, 'blend', method='stitcher'):
+                status, stitched_img = stitcher.composePanorama()
         
-        for img in images:
-            # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Detect features
-            kp, des = detector.detectAndCompute(gray, None)
-            keypoints.append(kp)
-            descriptors.append(des)
+        # Store the estimated transforms for later runs on this setup
+        if status == cv2.Stitcher_OK and profile:
+            updated = profile_from_stitcher(profile, stitcher, images, calibration)
+            if updated is not None:
+                save_profile(updated)
+    
+    if status != cv2.Stitcher_OK:
+        # If automatic stitching fails, try a feature-based approach
+        print("Automatic stitching failed, trying feature-based approach...")
+        with timed_stage(progress, 'features'):
+            stitched_img = feature_based_stitching(images, progress)
+        
+        if stitched_img is None:
+            print(f"Error: Image stitching failed with status {status}")
+            return None
+    
+    return stitched_img
+
+
+#function to create feature-based stitching using ORB
+def feature_based_stitching(images, progress=None):
+    progress = progress or no_progress
+    try:
+        # Detect features in all images concurrently; pair i is registered as soon
+        # as tile i is ready, while the following tiles are still being processed
+        features = [_tile_pool.submit(detect_features, img) for img in images]
+        keypoints_0, descriptors_0 = features[0].result()
         
         # Match features between adjacent images
         matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
@@ -142,8 +216,10 @@ def feature_based_stitching(images):
         
         # Stitch each subsequent image
         for i in range(1, len(images)):
+            keypoints_i, descriptors_i = features[i].result()
+            
             # Match features between result and current image
-            matches = matcher.match(descriptors[0], descriptors[i])
+            matches = matcher.match(descriptors_0, descriptors_i)
             
             # Sort matches by distance
             matches = sorted(matches, key=lambda x: x.distance)
@@ -153,18 +229,21 @@ def feature_based_stitching(images):
             
             if len(good_matches) < 4:
                 print(f"Not enough good matches found between images 0 and {i}")
+                progress('register', done=i, total=len(images) - 1, matched=False)
                 continue
             
             # Get matched keypoints
-            src_pts = np.float32([keypoints[0][m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-            dst_pts = np.float32([keypoints[i][m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+            src_pts = np.float32([keypoints_0[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+            dst_pts = np.float32([keypoints_i[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
             
             # Find homography
             H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
             
             if H is None:
                 print(f"Could not find homography between images 0 and {i}")
+                progress('register', done=i, total=len(images) - 1, matched=False)
                 continue
+            progress('register', done=i, total=len(images) - 1, matched=True)
             
             # Apply homography to stitch images
             h, w = result.shape[:2]
@@ -178,9 +257,10 @@ def feature_based_stitching(images):
             
             # Update result for next iteration
             result = result_warped
+            progress('blend', percent=round(100.0 * i / (len(images) - 1), 1))
             
-            # Update descriptors for next iteration
-            descriptors[0] = descriptors[i]
+            # Update keypoints and descriptors for next iteration
+            keypoints_0, descriptors_0 = keypoints_i, descriptors_i
         
         return result
         
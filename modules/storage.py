@@ -0,0 +1,357 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Filenames created by the app carry a uuid4 hex (also used to pick the shard)
+UUID_NAME = re.compile(r'[0-9a-f]{32}')
+
+# Files touched within this many seconds are never evicted. This protects
+# artifacts that are being written or are in use by another worker process.
+EVICTION_GRACE_SECONDS = 10 * 60
+
+REFERENCES_FILE = '.references.json'
+
+# Lock files in the storage root: one serialises reference updates between
+# processes, the other is held by the one process that sweeps the directory
+REFERENCES_LOCK = '.references.lock'
+SWEEPER_LOCK = '.sweeper.lock'
+
+# Paths held by each process (<pid>.json), so that a sweeper in one server
+# process keeps the files used by the jobs of another
+HOLDS_FOLDER = os.path.join(tempfile.gettempdir(), 'microimage_holds')
+
+# Files in use by running jobs of this process (absolute path -> number of holders)
+_holds = {}
+_holds_lock = threading.Lock()
+
+
+#function to keep files from being evicted while a job uses them
+@contextmanager
+def hold(*paths):
+    keys = [os.path.abspath(path) for path in paths if path]
+    with _holds_lock:
+        for key in keys:
+            _holds[key] = _holds.get(key, 0) + 1
+        _save_holds()
+    try:
+        yield
+    finally:
+        with _holds_lock:
+            for key in keys:
+                _holds[key] -= 1
+                if _holds[key] == 0:
+                    del _holds[key]
+            _save_holds()
+
+
+#function to publish the holds of this process (called with _holds_lock held)
+def _save_holds():
+    path = os.path.join(HOLDS_FOLDER, f"{os.getpid()}.json")
+    try:
+        if not _holds:
+            os.remove(path)
+            return
+        os.makedirs(HOLDS_FOLDER, exist_ok=True)
+        with open(f"{path}.part", 'w') as f:
+            json.dump(list(_holds), f)
+        os.replace(f"{path}.part", path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: Could not save held files: {str(e)}")
+
+
+#function to get the files held by running jobs of every process
+def held_paths():
+    with _holds_lock:
+        held = set(_holds)
+    try:
+        names = os.listdir(HOLDS_FOLDER)
+    except OSError:
+        return held
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            pid = int(name[:-len('.json')])
+        except ValueError:
+            continue
+        path = os.path.join(HOLDS_FOLDER, name)
+        if pid == os.getpid():
+            continue
+        if not _process_exists(pid):
+            # Left by a process that exited while holding files
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                held.update(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return held
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user, so it is alive
+        return True
+    return True
+
+
+class StorageManager:
+    """
+    Lifecycle manager for a directory of uploaded or processed images.
+
+    Files are stored in sharded subdirectories (root/ab/<filename>) so that no
+    directory grows without bound. A background sweeper evicts files that have
+    not been accessed for ttl_seconds, then the least recently used files
+    until the directory is under quota_bytes. Files held by a running job, or
+    referenced by an artifact that still exists (e.g. the tiles of a mosaic),
+    are kept (see hold() and add_reference()).
+
+    Several server processes may share a directory: references are kept in
+    a file updated under a file lock, and only one process runs the sweeper.
+    """
+
+    def __init__(self, root, quota_bytes=None, ttl_seconds=None, shard_levels=1):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self.shard_levels = shard_levels
+
+        self._lock = threading.Lock()
+        self._references = self._load_references()
+        self._sweeper = None
+        self._stop = threading.Event()
+        self._stats = {
+            'evicted_files': 0,
+            'evicted_bytes': 0,
+            'last_sweep': None,
+            'last_sweep_seconds': None,
+        }
+
+        os.makedirs(root, exist_ok=True)
+
+    #function to get the sharded path of a file, creating its shard directory if needed
+    def path_for(self, filename, create=True):
+        match = UUID_NAME.search(filename)
+        digest = match.group() if match else hashlib.md5(filename.encode()).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_levels)]
+        directory = os.path.join(self.root, *shards)
+        if create:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    #function to find an existing file (sharded, or flat from before sharding) and mark it as used
+    def find(self, filename):
+        if not filename or filename != os.path.basename(filename) or filename.startswith('.'):
+            return None
+        for path in (self.path_for(filename, create=False), os.path.join(self.root, filename)):
+            if os.path.isfile(path):
+                self.touch(path)
+                return path
+        return None
+
+    #function to record an access; only atime changes, so ETags (mtime-based) stay valid
+    def touch(self, path):
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    #function to keep a file for as long as the holder file (e.g. a mosaic) exists
+    def add_reference(self, path, holder_path):
+        key = os.path.abspath(path)
+        with self._lock, self._references_locked():
+            holders = self._references.setdefault(key, [])
+            holder = os.path.abspath(holder_path)
+            if holder not in holders:
+                holders.append(holder)
+            self._save_references()
+
+    def _is_referenced(self, key):
+        holders = self._references.get(key)
+        if not holders:
+            return False
+        live = [holder for holder in holders if os.path.exists(holder)]
+        if live:
+            self._references[key] = live
+            return True
+        del self._references[key]
+        return False
+
+    #function to lock the references of all processes, merging the saved ones into ours
+    @contextmanager
+    def _references_locked(self):
+        with open(os.path.join(self.root, REFERENCES_LOCK), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                for key, holders in self._load_references().items():
+                    ours = self._references.setdefault(key, [])
+                    ours.extend(holder for holder in holders if holder not in ours)
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_references(self):
+        try:
+            with open(os.path.join(self.root, REFERENCES_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_references(self):
+        path = os.path.join(self.root, REFERENCES_FILE)
+        with open(f"{path}.part", 'w') as f:
+            json.dump(self._references, f)
+        os.replace(f"{path}.part", path)
+
+    #function to list managed files as (path, size, last access) tuples
+    def _scan(self):
+        entries = []
+        pending = [(self.root, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if depth < self.shard_levels:
+                                pending.append((entry.path, depth + 1))
+                        elif UUID_NAME.search(entry.name):
+                            stat = entry.stat(follow_symlinks=False)
+                            entries.append((os.path.abspath(entry.path), stat.st_size,
+                                            max(stat.st_atime, stat.st_mtime)))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    #function to evict expired files, then least recently used files until under quota
+    def sweep(self):
+        started = time.time()
+        entries = self._scan()
+        total_bytes = sum(size for _, size, _ in entries)
+        evicted_files = 0
+        evicted_bytes = 0
+
+        held = held_paths()
+
+        # Evict with the references locked, so that no process adds a reference
+        # to a file that is being evicted
+        with self._lock, self._references_locked():
+            protected = set()
+            for path, _, last_access in entries:
+                if (path in held or started - last_access < EVICTION_GRACE_SECONDS
+                        or self._is_referenced(path)):
+                    protected.add(path)
+
+            # Forget references to files that no longer exist or whose holders are gone
+            existing = {path for path, _, _ in entries}
+            for key in [key for key in self._references if key not in existing]:
+                del self._references[key]
+            self._save_references()
+
+            # Least recently used first
+            entries.sort(key=lambda entry: entry[2])
+            for path, size, last_access in entries:
+                if path in protected:
+                    continue
+                expired = self.ttl_seconds is not None and started - last_access > self.ttl_seconds
+                over_quota = self.quota_bytes is not None and total_bytes > self.quota_bytes
+                if not (expired or over_quota):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Warning: Could not evict {path}: {str(e)}")
+                    continue
+                total_bytes -= size
+                evicted_files += 1
+                evicted_bytes += size
+
+        with self._lock:
+            self._stats['evicted_files'] += evicted_files
+            self._stats['evicted_bytes'] += evicted_bytes
+            self._stats['last_sweep'] = started
+            self._stats['last_sweep_seconds'] = time.time() - started
+
+        if evicted_files:
+            print(f"Evicted {evicted_files} files ({evicted_bytes} bytes) from {self.root}")
+        return evicted_files
+
+    #function to report usage and eviction statistics
+    def stats(self):
+        entries = self._scan()
+        root = os.path.abspath(self.root) + os.sep
+        held = [path for path in held_paths() if path.startswith(root)]
+        with self._lock:
+            stats = dict(self._stats)
+            stats['held_files'] = len(held)
+            stats['referenced_files'] = len(self._references)
+        stats.update({
+            'root': self.root,
+            'files': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'quota_bytes': self.quota_bytes,
+            'ttl_seconds': self.ttl_seconds,
+        })
+        return stats
+
+    #function to run sweep() periodically on a daemon thread
+    def start_sweeper(self, interval_seconds):
+        """
+        Only one process sweeps a directory: the sweepers of the other
+        processes wait, and one of them takes over if that process exits.
+        """
+        if self._sweeper is not None:
+            return
+
+        def run():
+            lock_file = None
+            while not self._stop.wait(interval_seconds):
+                if lock_file is None:
+                    lock_file = self._acquire_sweeper_lock()
+                    if lock_file is None:
+                        continue
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"Error in storage sweep of {self.root}: {str(e)}")
+            if lock_file is not None:
+                lock_file.close()
+
+        self._sweeper = threading.Thread(target=run, name=f"sweeper-{self.root}", daemon=True)
+        self._sweeper.start()
+
+    #function to become the sweeping process of the directory; returns the open lock file or None
+    def _acquire_sweeper_lock(self):
+        lock_file = open(os.path.join(self.root, SWEEPER_LOCK), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def stop_sweeper(self):
+        self._stop.set()
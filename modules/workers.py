@@ -0,0 +1,148 @@
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from modules import shm_store
+
+
+# Processing stages run in separate worker processes, so a long operation
+# never blocks the web server's threads on the GIL. Images are passed between
+# stages as shared-memory handles (see modules/shm_store.py).
+PROCESS_WORKERS = int(os.environ.get('MICROIMAGE_PROCESS_WORKERS', max(1, min(4, (os.cpu_count() or 2) // 2))))
+
+# Start method of worker and job processes. The fork server is a clean,
+# single-threaded process that imports the processing modules once; each new
+# process is forked from it ready to run, instead of starting a fresh
+# interpreter (spawn). Forking the multi-threaded web server itself is not
+# safe with OpenCV.
+START_METHOD = os.environ.get('MICROIMAGE_START_METHOD') or (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+PROCESS_CONTEXT = multiprocessing.get_context(START_METHOD)
+
+# Imported by the fork server (and by spawned processes on start-up)
+PRELOAD_MODULES = ['modules.stitch', 'modules.roi', 'modules.zoom', 'modules.autofocus',
+                   'modules.pipeline', 'modules.jobs']
+if START_METHOD == 'forkserver':
+    PROCESS_CONTEXT.set_forkserver_preload(PRELOAD_MODULES)
+
+# OpenCV threads per process (0: OpenCV's default, one per core)
+OPENCV_THREADS = int(os.environ.get('MICROIMAGE_OPENCV_THREADS', 0))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Set in job processes (see modules/jobs.py), which run the stages themselves
+_inline = False
+
+
+#function to load the processing modules and initialise OpenCV in this process
+def init_process(segment_directory=None):
+    """
+    Parameters:
+    - segment_directory: Segment directory of the server process, for worker
+      and job processes
+    """
+    if segment_directory is not None:
+        shm_store.attach_directory(segment_directory)
+
+    # Already imported in processes forked from the fork server. The web server
+    # process imports them here (warm-up) or on its first processing request
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+
+    import cv2
+    cv2.setUseOptimized(True)
+    if OPENCV_THREADS:
+        cv2.setNumThreads(OPENCV_THREADS)
+
+    # Objects the operations would otherwise build on their first call
+    from modules.autofocus import get_clahe
+    get_clahe()
+
+
+#function to prepare a worker process: its segments go to the directory of the server process
+def _init_worker(segment_directory):
+    init_process(segment_directory)
+    import cv2
+    import numpy as np
+    # Start OpenCV's thread pool now rather than during the first stage
+    cv2.GaussianBlur(np.zeros((256, 256, 3), np.uint8), (0, 0), 2.0)
+
+
+def _ready():
+    return os.getpid()
+
+
+#function to get the worker pool, starting it on first use
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS,
+                                        mp_context=PROCESS_CONTEXT,
+                                        initializer=_init_worker,
+                                        initargs=(shm_store.segment_directory(),))
+        return _pool
+
+
+#function to get everything a first request needs ready ahead of it (server process, at start-up)
+def warm_up():
+    """
+    Loads the processing modules of this process (single operations run
+    here), starts the fork server and starts every worker of the pool.
+
+    Returns:
+    - Seconds taken
+    """
+    started = time.perf_counter()
+    init_process()
+    if START_METHOD == 'forkserver':
+        from multiprocessing import forkserver
+        forkserver.ensure_running()
+
+    # The pool starts another worker for each task submitted while none is idle
+    pool = get_pool()
+    for future in [pool.submit(_ready) for _ in range(PROCESS_WORKERS)]:
+        future.result()
+    return time.perf_counter() - started
+
+
+#function to run stages in this process from now on (used by job processes)
+def run_inline():
+    global _inline
+    _inline = True
+
+
+#function to run a function in a worker process and wait for its result
+def run(fn, *args, progress=None, **kwargs):
+    """
+    The progress callback is only passed on when the function runs in this
+    process: callbacks cannot be sent to the worker pool.
+    """
+    if _inline:
+        return fn(*args, progress=progress, **kwargs)
+
+    pool = get_pool()
+    try:
+        return pool.submit(fn, *args, **kwargs).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool for the next job
+        global _pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+#function to stop the worker processes
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -1,6 +1,28 @@
 import cv2
 import numpy as np
 import os
+import threading
+from collections import OrderedDict
+
+from modules.encoding import write_image
+
+
+# Memory for the decoded image pyramids kept for interactive zooming (per
+# process). Least recently used pyramids are dropped to stay within it, and a
+# pyramid larger than the whole budget is not kept at all.
+PYRAMID_CACHE_BYTES = int(os.environ.get('MICROIMAGE_PYRAMID_CACHE_MB', 512)) * 1024 * 1024
+
+# Pyramid levels stop once the shorter side drops below this many pixels
+PYRAMID_MIN_SIZE = 256
+
+_pyramid_cache = OrderedDict()
+_pyramid_cache_bytes = 0
+_pyramid_lock = threading.Lock()
+
+# Gentle sharpening applied after upsampling
+UPSAMPLE_SHARPEN_KERNEL = np.array([[-0.3, -0.3, -0.3],
+                                    [-0.3, 3.4, -0.3],
+                                    [-0.3, -0.3, -0.3]])
 
 
 #function to apply zooming
@@ -48,10 +70,7 @@ def zoomed_image(input_path, output_path, zoom_factor=2.0):
         zoomed = cv2.fastNlMeansDenoisingColored(zoomed, None, 10, 10, 7, 21)
         
         # Then apply gentle sharpening
-        kernel = np.array([[-0.3, -0.3, -0.3],
-                          [-0.3, 3.4, -0.3],
-                          [-0.3, -0.3, -0.3]])
-        zoomed = cv2.filter2D(zoomed, -1, kernel)
+        zoomed = cv2.filter2D(zoomed, -1, UPSAMPLE_SHARPEN_KERNEL)
         
         # Save the zoomed image
         cv2.imwrite(output_path, zoomed)
@@ -115,4 +134,152 @@ def zoom_roi(input_path, output_path, x, y, width, height, zoom_factor=2.0):
         
     except Exception as e:
         print(f"Error in ROI zooming: {str(e)}")
+        return False
+
+
+
+#function to build a resampling pyramid (level 0 is the full-resolution image)
+def build_pyramid(image, min_size=PYRAMID_MIN_SIZE, max_level=None):
+    levels = [image]
+    while min(levels[-1].shape[:2]) // 2 >= min_size and (max_level is None or len(levels) <= max_level):
+        levels.append(cv2.pyrDown(levels[-1]))
+    return levels
+
+
+#function to get the pyramid level a zoomed view of an image of width x height is resampled from
+def zoom_level(width, height, zoom_factor=1.0, max_width=1024, max_height=1024, levels=None):
+    """
+    Parameters:
+    - levels: Number of pyramid levels available (default: unlimited)
+    """
+    scale = min(max_width / (width / zoom_factor), max_height / (height / zoom_factor))
+    # The coarsest level that still has enough resolution
+    level = 0
+    while (levels is None or level + 1 < levels) and scale * (2 ** (level + 1)) <= 1.0:
+        level += 1
+    return level
+
+
+#function to get the cached pyramid of an image, building it on first use
+def get_pyramid(input_path):
+    key = os.path.abspath(input_path)
+    stat = os.stat(key)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _pyramid_lock:
+        entry = _pyramid_cache.get(key)
+        if entry is not None and entry[0] == signature:
+            _pyramid_cache.move_to_end(key)
+            return entry[1]
+
+    image = cv2.imread(input_path)
+    if image is None:
+        return None
+    levels = build_pyramid(image)
+    size = sum(level.nbytes for level in levels)
+
+    global _pyramid_cache_bytes
+    with _pyramid_lock:
+        previous = _pyramid_cache.pop(key, None)
+        if previous is not None:
+            _pyramid_cache_bytes -= previous[2]
+        if size <= PYRAMID_CACHE_BYTES:
+            _pyramid_cache[key] = (signature, levels, size)
+            _pyramid_cache_bytes += size
+            while _pyramid_cache_bytes > PYRAMID_CACHE_BYTES:
+                _, (_, _, evicted) = _pyramid_cache.popitem(last=False)
+                _pyramid_cache_bytes -= evicted
+    return levels
+
+
+#function to render the visible region of a pyramid into a viewport of at most max_width x max_height
+def render_zoom(levels, zoom_factor=1.0, center_x=None, center_y=None, max_width=1024, max_height=1024):
+    """
+    Returns:
+    - (zoomed image, pyramid level it was resampled from)
+    """
+    # Visible region in full-resolution coordinates
+    height, width = levels[0].shape[:2]
+    roi_width = width / zoom_factor
+    roi_height = height / zoom_factor
+
+    if center_x is None:
+        center_x = width / 2
+    if center_y is None:
+        center_y = height / 2
+
+    # Ensure the visible region is within image boundaries
+    x = min(max(center_x - roi_width / 2, 0), width - roi_width)
+    y = min(max(center_y - roi_height / 2, 0), height - roi_height)
+
+    # Fit the visible region into the viewport, keeping its aspect ratio
+    scale = min(max_width / roi_width, max_height / roi_height)
+    out_width = max(1, int(round(roi_width * scale)))
+    out_height = max(1, int(round(roi_height * scale)))
+
+    level = zoom_level(width, height, zoom_factor, max_width, max_height, len(levels))
+    source = levels[level]
+    factor = 2 ** level
+
+    # The exact visible region at this level, and the output pixels per source
+    # pixel. The source pixels the region touches are resampled at exactly that
+    # scale and the region is cut out of the result, so the view has the same
+    # scale in both directions and stays on the requested centre (to within
+    # half an output pixel).
+    left = x / factor
+    top = y / factor
+    scale_x = out_width * factor / roi_width
+    scale_y = out_height * factor / roi_height
+
+    x0 = int(left)
+    y0 = int(top)
+    x1 = min(source.shape[1], int(np.ceil(left + out_width / scale_x)))
+    y1 = min(source.shape[0], int(np.ceil(top + out_height / scale_y)))
+    # Downsampling averages areas; upsampling uses Lanczos
+    interpolation = cv2.INTER_AREA if scale_x < 1.0 else cv2.INTER_LANCZOS4
+    resized = cv2.resize(source[y0:y1, x0:x1], None, fx=scale_x, fy=scale_y, interpolation=interpolation)
+
+    offset_x = min(int(round((left - x0) * scale_x)), max(0, resized.shape[1] - out_width))
+    offset_y = min(int(round((top - y0) * scale_y)), max(0, resized.shape[0] - out_height))
+    zoomed = resized[offset_y:offset_y + out_height, offset_x:offset_x + out_width]
+    if zoomed.shape[:2] != (out_height, out_width):
+        zoomed = cv2.resize(zoomed, (out_width, out_height), interpolation=interpolation)
+
+    if scale_x >= 1.0:
+        # The same gentle sharpening as zoomed_image
+        zoomed = cv2.filter2D(zoomed, -1, UPSAMPLE_SHARPEN_KERNEL)
+
+    return zoomed, level
+
+
+#function to render a zoomed view of any factor and centre, bounded by the viewport size
+def zoom_view(input_path, output_path, zoom_factor=1.0, center_x=None, center_y=None,
+              max_width=1024, max_height=1024, quality=None, preview_path=None):
+    try:
+        # Check if the input image exists
+        if not os.path.exists(input_path):
+            print(f"Error: Input image {input_path} does not exist")
+            return False
+
+        if zoom_factor < 1.0:
+            print("Error: Zoom factor must be at least 1")
+            return False
+
+        levels = get_pyramid(input_path)
+        if levels is None:
+            print(f"Error: Failed to read image {input_path}")
+            return False
+
+        zoomed, level = render_zoom(levels, zoom_factor, center_x, center_y, max_width, max_height)
+
+        # Save the zoomed view
+        if write_image(output_path, zoomed, quality, preview_path):
+            print(f"Zoomed view saved to {output_path} (pyramid level {level})")
+            return True
+        else:
+            print(f"Error: Failed to save zoomed view to {output_path}")
+            return False
+
+    except Exception as e:
+        print(f"Error in zoomed view: {str(e)}")
         return False
\ No newline at end of file